@@ -1,15 +1,45 @@
+import hashlib
 import json
 import os
 import logging
+import math
+import time
 import traceback
+import uuid
+from functools import partial
 
-import requests
 import openai
-import tiktoken
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from logging.handlers import TimedRotatingFileHandler
 from flask import Flask, Response, request, jsonify, send_from_directory, abort
 from backend.history.postgresdbservice import Database
+from backend.history.migrate import MigrationRunner
+from backend.history.compaction import HistoryCompactor, LocalSummaryStore
+from backend.history.conversationstate import ConversationStore, ConversationAccessDenied
+from backend.history.users import UserDirectory
+from backend.tokenisation.tokenisationservice import TokenisationClient
+from backend.tokenisation.tokenmap import TokenMap, ConversationTokenMaps, StreamingUnmasker, UserTokenStore
+from backend.tokenisation.maskcache import MaskCache
+from backend.tokenisation.prescreen import PiiPrescreen
+from backend.tokenisation.chunking import mask_in_chunks
+from backend.llm.tokenbudget import (get_encoding, trim_to_budget, count_message_tokens, count_prompt_tokens,
+                                    CachedTokenCounter)
+from backend.llm.routing import ModelRouter
+from backend.retrieval.bm25 import DocumentRetriever
+from backend.llm.completioncache import CompletionCache, replay_completion, record_stream
+from backend.llm.singleflight import SingleFlight, RedisFlightBackend
+from backend.llm.openaiservice import OpenAIClient, Deadline, DeadlineExceeded
+from backend.llm.admission import AdmissionController, AdmissionRejected, LocalRateLimiter, RedisRateLimiter
+from backend.scheduling.fairshare import FairShareScheduler, QueueRejected, RedisUserSlots
+from openai.util import convert_to_openai_object
+from sqlalchemy.exc import IntegrityError
+from backend.cache.redisservice import get_redis_client
+from backend.monitoring.metrics import metrics
 from dotenv import load_dotenv, find_dotenv, set_key, dotenv_values
 from flask_executor import Executor
 from backend.fine_tuning.fine_tuning_model import Fine_Tune
@@ -62,6 +92,35 @@ OPENAI_MODEL = os.environ.get("OPENAI_MODEL")
 OPENAI_SYSTEM_MESSAGE = os.environ.get("OPENAI_SYSTEM_MESSAGE")
 OPENAI_PDF_SYSTEM_MESSAGE = os.environ.get("OPENAI_PDF_SYSTEM_MESSAGE")
 OPENAI_MAX_TOKENS_PROMPT = os.environ.get("OPENAI_MAX_TOKENS_PROMPT", 3000)
+OPENAI_CONNECT_TIMEOUT = os.environ.get("OPENAI_CONNECT_TIMEOUT", 3.05)
+OPENAI_READ_TIMEOUT = os.environ.get("OPENAI_READ_TIMEOUT", 45)
+OPENAI_MAX_RETRIES = os.environ.get("OPENAI_MAX_RETRIES", 2)
+OPENAI_BACKOFF_MAX = os.environ.get("OPENAI_BACKOFF_MAX", 8)
+OPENAI_POOL_MAXSIZE = os.environ.get("OPENAI_POOL_MAXSIZE", 10)
+
+# Overall budget for one conversation request, kept below the uwsgi --http-timeout of 60 seconds
+REQUEST_DEADLINE_SECONDS = os.environ.get("REQUEST_DEADLINE_SECONDS", 55)
+UNMASK_RESERVE_SECONDS = os.environ.get("UNMASK_RESERVE_SECONDS", 3)
+
+# JSON list of {"model", "context_window", "cost", "latency"}; each prompt goes to the cheapest model that holds it,
+# OPENAI_MODEL included. Without it every request uses OPENAI_MODEL.
+OPENAI_MODEL_ROUTES = os.environ.get("OPENAI_MODEL_ROUTES")
+# "True" sends every prompt OPENAI_MODEL can hold to it whatever it costs, e.g. for a fine-tuned model
+OPENAI_MODEL_PREFERRED = os.environ.get("OPENAI_MODEL_PREFERRED", "False")
+if OPENAI_MODEL_ROUTES:
+    model_router = ModelRouter.from_json(OPENAI_MODEL_ROUTES, OPENAI_MODEL,
+                                         int(OPENAI_MAX_TOKENS_PROMPT) + int(OPENAI_MAX_TOKENS),
+                                         prefer_default=OPENAI_MODEL_PREFERRED == "True")
+else:
+    model_router = None
+
+# also installs the client's pooled session as openai.requestssession for every openai call in this process
+openai_client = OpenAIClient(OPENAI_API_KEY,
+                             connect_timeout=OPENAI_CONNECT_TIMEOUT,
+                             read_timeout=OPENAI_READ_TIMEOUT,
+                             max_retries=OPENAI_MAX_RETRIES,
+                             backoff_max=OPENAI_BACKOFF_MAX,
+                             pool_maxsize=OPENAI_POOL_MAXSIZE)
 
 # Postgres Integration Settings
 POSTGRES_USER = os.environ.get("POSTGRES_USER")
@@ -69,160 +128,618 @@ POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
 POSTGRES_HOST = os.environ.get("POSTGRES_HOST")
 POSTGRES_DATABASE = os.environ.get("POSTGRES_DATABASE")
 POSTGRES_CLIENT = os.environ.get("POSTGRES_CLIENT")
-
-SHOULD_STREAM = False
+# Turn off when connecting through a transaction pooling proxy such as pgbouncer
+POSTGRES_PREPARED_STATEMENTS = os.environ.get("POSTGRES_PREPARED_STATEMENTS", "True")
+# Deployments that do not run "python -m backend.history.migrate" can apply pending migrations on startup instead
+POSTGRES_RUN_MIGRATIONS = os.environ.get("POSTGRES_RUN_MIGRATIONS", "False")
+
+SHOULD_STREAM = os.environ.get("SHOULD_STREAM", "False") == "True"
+# Top level fields of a completion response; clients can pick their own with ?fields=choices,history_metadata
+RESPONSE_FIELDS = ("id", "model", "created", "object", "choices", "history_metadata")
+RESPONSE_DEFAULT_FIELDS = os.environ.get("RESPONSE_DEFAULT_FIELDS", "id,choices,history_metadata")
+# "cumulative" repeats all content so far in every frame, "delta" sends only the new text. Clients that read
+# deltas ask for them with "stream_format": "delta"; the default stays cumulative for those that do not.
+STREAM_FORMAT = os.environ.get("STREAM_FORMAT", "cumulative")
 
 #
 TOKENISATION_MASK_URL = os.environ.get("TOKENISATION_MASK_URL")
 TOKENISATION_UNMASK_URL = os.environ.get("TOKENISATION_UNMASK_URL")
 TOKENISATION_TOKEN = os.environ.get("TOKENISATION_TOKEN")
+TOKENISATION_CONNECT_TIMEOUT = os.environ.get("TOKENISATION_CONNECT_TIMEOUT", 3.05)
+TOKENISATION_READ_TIMEOUT = os.environ.get("TOKENISATION_READ_TIMEOUT", 30)
+TOKENISATION_MAX_RETRIES = os.environ.get("TOKENISATION_MAX_RETRIES", 2)
+TOKENISATION_BACKOFF_FACTOR = os.environ.get("TOKENISATION_BACKOFF_FACTOR", 0.25)
+# one mask or unmask call, retries included, must finish well inside the uwsgi --http-timeout of 60 seconds
+TOKENISATION_TOTAL_TIMEOUT = os.environ.get("TOKENISATION_TOTAL_TIMEOUT", 20)
+TOKENISATION_POOL_CONNECTIONS = os.environ.get("TOKENISATION_POOL_CONNECTIONS", 2)
+TOKENISATION_POOL_MAXSIZE = os.environ.get("TOKENISATION_POOL_MAXSIZE", 10)
+
+tokenisation_client = TokenisationClient(TOKENISATION_MASK_URL, TOKENISATION_UNMASK_URL, TOKENISATION_TOKEN,
+                                         connect_timeout=TOKENISATION_CONNECT_TIMEOUT,
+                                         read_timeout=TOKENISATION_READ_TIMEOUT,
+                                         max_retries=TOKENISATION_MAX_RETRIES,
+                                         backoff_factor=TOKENISATION_BACKOFF_FACTOR,
+                                         pool_connections=TOKENISATION_POOL_CONNECTIONS,
+                                         pool_maxsize=TOKENISATION_POOL_MAXSIZE,
+                                         total_timeout=TOKENISATION_TOTAL_TIMEOUT)
+TOKEN_MAP_MAX_CONVERSATIONS = os.environ.get("TOKEN_MAP_MAX_CONVERSATIONS", 1000)
+conversation_token_maps = ConversationTokenMaps(TOKEN_MAP_MAX_CONVERSATIONS)
+
+# Shared cache settings
+REDIS_URL = os.environ.get("REDIS_URL")
+MASK_CACHE_ENABLED = os.environ.get("MASK_CACHE_ENABLED", "True")
+MASK_CACHE_MAX_ENTRIES = os.environ.get("MASK_CACHE_MAX_ENTRIES", 2048)
+MASK_CACHE_MAX_BYTES = os.environ.get("MASK_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+MASK_CACHE_TTL_SECONDS = os.environ.get("MASK_CACHE_TTL_SECONDS", 900)
+
+if MASK_CACHE_ENABLED == "True":
+    mask_cache = MaskCache(TOKENISATION_TOKEN,
+                           max_entries=MASK_CACHE_MAX_ENTRIES,
+                           ttl=MASK_CACHE_TTL_SECONDS,
+                           max_bytes=MASK_CACHE_MAX_BYTES,
+                           redis_client=get_redis_client(REDIS_URL))
+else:
+    mask_cache = None
+
+# PII pre-screen settings: "off", "shadow" (screen and measure only) or "enforce" (skip the mask api)
+PII_PRESCREEN_MODE = os.environ.get("PII_PRESCREEN_MODE", "shadow")
+PII_PRESCREEN_MAX_LENGTH = os.environ.get("PII_PRESCREEN_MAX_LENGTH", 200)
+PII_PRESCREEN_COMMON_WORDS = os.environ.get("PII_PRESCREEN_COMMON_WORDS", "")
+
+if PII_PRESCREEN_MODE in ("shadow", "enforce"):
+    pii_prescreen = PiiPrescreen(PII_PRESCREEN_MAX_LENGTH, PII_PRESCREEN_COMMON_WORDS.split(","))
+else:
+    pii_prescreen = None
+
+if mask_cache:
+    metrics.register("mask_cache", mask_cache.stats)
+
+# token -> value pairs each user was shown, kept in redis when REDIS_URL is set so every worker can unmask them
+TOKEN_STORE_TTL_SECONDS = os.environ.get("TOKEN_STORE_TTL_SECONDS", 86400)
+token_store = UserTokenStore(TOKENISATION_TOKEN, get_redis_client(REDIS_URL), TOKEN_STORE_TTL_SECONDS,
+                             TOKEN_MAP_MAX_CONVERSATIONS)
+
+# Uploaded documents are masked in chunks of at most this many characters, a few chunks at a time
+MASK_CHUNK_MAX_CHARS = os.environ.get("MASK_CHUNK_MAX_CHARS", 8000)
+MASK_CHUNK_CONCURRENCY = os.environ.get("MASK_CHUNK_CONCURRENCY", 4)
+
+# Token counting settings
+TOKEN_COUNT_CACHE_MAX_ENTRIES = os.environ.get("TOKEN_COUNT_CACHE_MAX_ENTRIES", 20000)
+UPLOAD_MAX_TOKENS = os.environ.get("UPLOAD_MAX_TOKENS")
+
+token_counter = CachedTokenCounter(TOKEN_COUNT_CACHE_MAX_ENTRIES)
+metrics.register("token_count_cache", token_counter.stats)
+
+# Completion cache settings, only used for private conversations with temperature 0
+COMPLETION_CACHE_ENABLED = os.environ.get("COMPLETION_CACHE_ENABLED", "False")
+COMPLETION_CACHE_MAX_ENTRIES = os.environ.get("COMPLETION_CACHE_MAX_ENTRIES", 1000)
+COMPLETION_CACHE_MAX_BYTES = os.environ.get("COMPLETION_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+COMPLETION_CACHE_TTL_SECONDS = os.environ.get("COMPLETION_CACHE_TTL_SECONDS", 3600)
+COMPLETION_CACHE_TENANT_HEADER = os.environ.get("COMPLETION_CACHE_TENANT_HEADER")
+
+if COMPLETION_CACHE_ENABLED == "True":
+    completion_cache = CompletionCache(max_entries=COMPLETION_CACHE_MAX_ENTRIES,
+                                       ttl=COMPLETION_CACHE_TTL_SECONDS,
+                                       max_bytes=COMPLETION_CACHE_MAX_BYTES,
+                                       redis_client=get_redis_client(REDIS_URL))
+    metrics.register("completion_cache", completion_cache.stats)
+else:
+    completion_cache = None
+
+# Identical in-flight private requests share one upstream call, across workers when redis is configured
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "True")
+SINGLE_FLIGHT_WAIT_SECONDS = os.environ.get("SINGLE_FLIGHT_WAIT_SECONDS", 60)
+
+if SINGLE_FLIGHT_ENABLED == "True":
+    redis_client = get_redis_client(REDIS_URL)
+    single_flight = SingleFlight(
+        backend=RedisFlightBackend(redis_client,
+                                   dumps=lambda completion: dumps_json(completion.to_dict_recursive()),
+                                   loads=lambda raw: convert_to_openai_object(json.loads(raw)),
+                                   wait_timeout=SINGLE_FLIGHT_WAIT_SECONDS) if redis_client else None,
+        metrics=metrics)
+else:
+    single_flight = None
+
+# Admission control against the OpenAI quota, disabled unless both limits are set
+OPENAI_TPM_LIMIT = os.environ.get("OPENAI_TPM_LIMIT")
+OPENAI_RPM_LIMIT = os.environ.get("OPENAI_RPM_LIMIT")
+ADMISSION_MAX_QUEUE = os.environ.get("ADMISSION_MAX_QUEUE", 8)
+ADMISSION_MAX_WAIT_SECONDS = os.environ.get("ADMISSION_MAX_WAIT_SECONDS", 10)
+
+if OPENAI_TPM_LIMIT and OPENAI_RPM_LIMIT:
+    redis_client = get_redis_client(REDIS_URL)
+    if redis_client:
+        rate_limiter = RedisRateLimiter(redis_client, OPENAI_TPM_LIMIT, OPENAI_RPM_LIMIT,
+                                        stale_after=2 * float(ADMISSION_MAX_WAIT_SECONDS))
+    else:
+        rate_limiter = LocalRateLimiter(OPENAI_TPM_LIMIT, OPENAI_RPM_LIMIT)
+    admission_controller = AdmissionController(rate_limiter, ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS,
+                                               metrics=metrics)
+    metrics.register("admission", admission_controller.stats)
+else:
+    admission_controller = None
+
+# Uploaded documents longer than RETRIEVAL_MIN_CHARS are indexed and only the best matching chunks are prompted
+RETRIEVAL_ENABLED = os.environ.get("RETRIEVAL_ENABLED", "True")
+RETRIEVAL_TOP_K = os.environ.get("RETRIEVAL_TOP_K", 4)
+RETRIEVAL_CHUNK_CHARS = os.environ.get("RETRIEVAL_CHUNK_CHARS", 1500)
+RETRIEVAL_MIN_CHARS = os.environ.get("RETRIEVAL_MIN_CHARS", 6000)
+RETRIEVAL_MAX_DOCUMENTS = os.environ.get("RETRIEVAL_MAX_DOCUMENTS", 64)
+
+if RETRIEVAL_ENABLED == "True":
+    document_retriever = DocumentRetriever(RETRIEVAL_CHUNK_CHARS, RETRIEVAL_TOP_K, RETRIEVAL_MIN_CHARS,
+                                           RETRIEVAL_MAX_DOCUMENTS)
+    metrics.register("document_index_cache", document_retriever.stats)
+else:
+    document_retriever = None
+
+# Per-user fair share of the /history/generate workers. The round-robin queue is per worker process and only
+# forms when uwsgi runs several threads per process (WebApp.Dockerfile runs 4); across processes the per-user
+# cap is shared through redis, and a user already at that cap is answered with 429 straight away.
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "False")
+SCHEDULER_MAX_IN_FLIGHT = os.environ.get("SCHEDULER_MAX_IN_FLIGHT", 4)
+SCHEDULER_MAX_PER_USER = os.environ.get("SCHEDULER_MAX_PER_USER", 2)
+SCHEDULER_MAX_QUEUE = os.environ.get("SCHEDULER_MAX_QUEUE", 32)
+SCHEDULER_MAX_WAIT_SECONDS = os.environ.get("SCHEDULER_MAX_WAIT_SECONDS", 20)
+
+if SCHEDULER_ENABLED == "True":
+    redis_client = get_redis_client(REDIS_URL)
+    scheduler = FairShareScheduler(SCHEDULER_MAX_IN_FLIGHT, SCHEDULER_MAX_PER_USER, SCHEDULER_MAX_QUEUE,
+                                   SCHEDULER_MAX_WAIT_SECONDS,
+                                   shared_slots=RedisUserSlots(redis_client, SCHEDULER_MAX_PER_USER)
+                                   if redis_client else None,
+                                   metrics=metrics)
+    metrics.register("scheduler", scheduler.stats)
+else:
+    scheduler = None
 
 if POSTGRES_CLIENT == "True":
-    postgres_db_client = Database(POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_DATABASE)
+    if POSTGRES_RUN_MIGRATIONS == "True":
+        # before the client probes the schema, so a database migrated here is usable from the first request
+        try:
+            Database.get_or_initialize_connection_pool(POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST,
+                                                       POSTGRES_DATABASE)
+            for migration in MigrationRunner(Database.db_connection_pool).run():
+                logger.info(f"Applied migration {migration.version:04d}_{migration.name}")
+        except Exception as e:
+            logger.error(f"Schema migration failed - {str(e)}")
+    postgres_db_client = Database(POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_DATABASE,
+                                  prepared_statements=POSTGRES_PREPARED_STATEMENTS == "True")
 else:
     postgres_db_client = None
+
+# Clients that send {"delta": true} post only the new turn, earlier turns are loaded from openai_chat.messages
+CONVERSATION_CACHE_MAX_ENTRIES = os.environ.get("CONVERSATION_CACHE_MAX_ENTRIES", 1000)
+CONVERSATION_CACHE_TTL_SECONDS = os.environ.get("CONVERSATION_CACHE_TTL_SECONDS", 900)
+
+if postgres_db_client:
+    conversation_store = ConversationStore(postgres_db_client, CONVERSATION_CACHE_MAX_ENTRIES,
+                                           CONVERSATION_CACHE_TTL_SECONDS)
+    metrics.register("conversation_cache", conversation_store.stats)
+else:
+    conversation_store = None
+
+# email -> user_id is resolved once per worker and then served from memory until the ttl expires,
+# or until a deletion bumps the user's version in redis when REDIS_URL is set
+USER_CACHE_MAX_ENTRIES = os.environ.get("USER_CACHE_MAX_ENTRIES", 10000)
+USER_CACHE_TTL_SECONDS = os.environ.get("USER_CACHE_TTL_SECONDS", 300)
+
+if postgres_db_client:
+    user_directory = UserDirectory(postgres_db_client, USER_CACHE_MAX_ENTRIES, USER_CACHE_TTL_SECONDS,
+                                   redis_client=get_redis_client(REDIS_URL))
+    metrics.register("user_cache", user_directory.stats)
+else:
+    user_directory = None
+
+# Older turns are folded into a running summary in the background instead of being dropped from the prompt
+COMPACTION_ENABLED = os.environ.get("COMPACTION_ENABLED", "False")
+COMPACTION_TRIGGER_MESSAGES = os.environ.get("COMPACTION_TRIGGER_MESSAGES", 12)
+COMPACTION_KEEP_RECENT = os.environ.get("COMPACTION_KEEP_RECENT", 6)
+COMPACTION_MAX_TOKENS = os.environ.get("COMPACTION_MAX_TOKENS", 500)
+COMPACTION_SYSTEM_MESSAGE = os.environ.get(
+    "COMPACTION_SYSTEM_MESSAGE",
+    "Summarise the conversation below, merging it into the existing summary if one is given. Keep facts, "
+    "decisions and open questions. Copy placeholders such as <PER>abc</PER> exactly as they appear.")
+COMPACTION_SUMMARY_MESSAGE = os.environ.get("COMPACTION_SUMMARY_MESSAGE",
+                                            "Summary of the earlier conversation:")
+
+if COMPACTION_ENABLED == "True":
+    history_compactor = HistoryCompactor(
+        postgres_db_client if postgres_db_client and postgres_db_client.postgres_flag else LocalSummaryStore(),
+        summarise=lambda summary, messages: summarise_history(summary, messages),
+        submit=executor.submit,
+        trigger_messages=COMPACTION_TRIGGER_MESSAGES,
+        keep_recent=COMPACTION_KEEP_RECENT,
+        metrics=metrics)
+else:
+    history_compactor = None
 # Initialize a PostgresDB client with AAD auth and containers
 cosmos_conversation_client = None
 
 
-def format_as_ndjson(obj: dict) -> str:
-    obj['history_metadata']['date'] = datetime.utcnow().isoformat()
-    obj['history_metadata']['conversation_id'] = str(obj['history_metadata']['conversation_id'])
-    return json.dumps(obj, ensure_ascii=False) + "\n"
+def stamp_history_metadata(history_metadata):
+    history_metadata['date'] = datetime.utcnow().isoformat()
+    history_metadata['conversation_id'] = str(history_metadata['conversation_id'])
+    return history_metadata
+
+
+def dumps_json(obj) -> str:
+    if orjson:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def json_response(obj, status=200):
+    return Response(dumps_json(obj), status=status, mimetype="application/json")
+
+
+def get_response_fields():
+    fields = [field for field in (request.args.get("fields") or RESPONSE_DEFAULT_FIELDS).split(",")
+              if field in RESPONSE_FIELDS]
+    return tuple(fields) or RESPONSE_FIELDS
+
+
+def select_fields(obj, fields=None):
+    if fields is None:
+        return obj
+    return {key: value for key, value in obj.items() if key in fields}
+
+
+def format_as_ndjson(obj: dict, stamp=True) -> str:
+    if stamp and 'history_metadata' in obj:
+        stamp_history_metadata(obj['history_metadata'])
+    return dumps_json(obj) + "\n"
 
 
-def stream_without_data(response, history_metadata={}):
+def stream_without_data(response, history_metadata={}, unmasker=None, message_fields=None, cumulative=False,
+                        on_complete=None, fields=None):
+    # delta frames carry only the new text; the final frame carries the full message and the metadata.
+    # cumulative=True keeps the old format, where every frame repeats all the content so far.
     response_text = ""
-    for line in response:
-        delta_text = line["choices"][0]["delta"].get('content')
-        if delta_text and delta_text != "[DONE]":
+    line = None
+    stamp_history_metadata(history_metadata)
+    try:
+        for line in response:
+            if not line["choices"]:
+                continue
+            delta_text = line["choices"][0]["delta"].get('content')
+            if not delta_text or delta_text == "[DONE]":
+                continue
+            if unmasker:
+                delta_text = unmasker.feed(delta_text)
             response_text += delta_text
+            if cumulative:
+                response_obj = {
+                    "id": line["id"],
+                    "model": line["model"],
+                    "created": line["created"],
+                    "object": line["object"],
+                    "choices": [{
+                        "messages": [{
+                            "role": "assistant",
+                            "content": response_text
+                        }]
+                    }],
+                    "history_metadata": history_metadata
+                }
+                yield format_as_ndjson(select_fields(response_obj, fields), stamp=False)
+            elif delta_text:
+                yield format_as_ndjson({"choices": [{"delta": {"content": delta_text}}]}, stamp=False)
+
+        if unmasker:
+            response_text += unmasker.flush()
+        message = {
+            "role": "assistant",
+            "content": response_text,
+            "masked_content_assistant": unmasker.masked_text if unmasker else None
+        }
+        message.update(message_fields or {})
+        if on_complete:
+            on_complete(response_text, message["masked_content_assistant"])
         response_obj = {
-            "id": line["id"],
-            "model": line["model"],
-            "created": line["created"],
-            "object": line["object"],
+            "id": line["id"] if line else None,
+            "model": line["model"] if line else None,
+            "created": line["created"] if line else None,
+            "object": "chat.completion",
             "choices": [{
-                "messages": [{
-                    "role": "assistant",
-                    "content": response_text
-                }]
+                "messages": [message]
             }],
             "history_metadata": history_metadata
         }
-        yield format_as_ndjson(response_obj)
+        logger.info("End conversation_without_data stream")
+        yield format_as_ndjson(select_fields(response_obj, fields), stamp=False)
+    except Exception as e:
+        logger.error(f"Error in stream_without_data - {str(e)}")
+        logger.error(traceback.format_exc())
+        yield format_as_ndjson({"error": str(e)}, stamp=False)
 
 
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
+    return token_counter(string, get_encoding(encoding_name))
+
+
+def prescreen_contents(contents):
+    clean = []
+    for content in contents:
+        reason = pii_prescreen.screen(content) if pii_prescreen else "disabled"
+        if reason is None:
+            metrics.increment("pii_prescreen.clean")
+        elif pii_prescreen:
+            metrics.increment(f"pii_prescreen.detected.{reason}")
+        clean.append(reason is None)
+    return clean
+
+
+def tokenisation_mask_batch_call(contents):
+    if not contents:
+        return []
+
+    clean = prescreen_contents(contents)
+    results = []
+    for content, is_clean in zip(contents, clean):
+        if is_clean and PII_PRESCREEN_MODE == "enforce":
+            metrics.increment("pii_prescreen.skipped")
+            results.append((content, [], []))
+        else:
+            results.append(mask_cache.get(content) if mask_cache else None)
+
+    # identical texts in one batch are only sent once
+    pending = list(dict.fromkeys(content for content, result in zip(contents, results) if result is None))
+    if pending:
+        masked = dict(zip(pending, tokenisation_mask_remote_call(pending)))
+        for content, result in masked.items():
+            if mask_cache:
+                mask_cache.set(content, result)
+        results = [result if result is not None else masked[content] for content, result in zip(contents, results)]
+    else:
+        logger.info(f"mask_api call skipped for all {len(contents)} values")
 
-def tokenisation_mask_call(content):
-    pii_identified = []
-    identified_tokens = []
+    if PII_PRESCREEN_MODE == "shadow":
+        for is_clean, (_, pii, _) in zip(clean, results):
+            if is_clean:
+                # the mask api found pii the pre-screen would have let through
+                metrics.increment("pii_prescreen.false_negative" if pii else "pii_prescreen.true_negative")
+    return results
 
-    payload = {"mask": [{"value": content}]}
-    headers = {
-        "Authorization": f"Bearer {TOKENISATION_TOKEN}",
-        "Content-Type": "application/json"
-    }
 
+def tokenisation_mask_remote_call(contents):
     try:
-        response = requests.put(TOKENISATION_MASK_URL, json=payload, headers=headers)
+        response = tokenisation_client.mask(contents)
     except Exception as e:
         logger.error(f"Error in mask api call - {str(e)}")
         raise Exception("Error in mask api call")
 
     try:
-        if response.json()["success"]:
-            logger.info(f"mask_successful - Response: {response.json()}")
-            masked_response = response.json()["data"][0]["token_value"]
+        response_json = response.json()
+        if response_json["success"]:
+            logger.info(f"mask_successful - Response: {response_json}")
+            data = response_json["data"]
         else:
-            logger.error(f"Error in mask call - Response : {response.json()}")
+            logger.error(f"Error in mask call - Response : {response_json}")
+            raise Exception("Error in mask api call")
+        if len(data) != len(contents):
+            logger.error(f"Error in mask call - expected {len(contents)} results, got {len(data)}")
             raise Exception("Error in mask api call")
     except Exception as e:
         logger.error(f"Error in mask api call - {str(e)}")
         raise Exception("Error in mask api call")
 
+    results = []
+    for item in data:
+        pii_identified = []
+        identified_tokens = []
+        try:
+            for token in item["individual_tokens"]:
+                identified_tokens.append({"key": token['prefix'] + token['token'] + token['suffix']})
+                pii_identified.append(token["value"])
+        except Exception as e:
+            pass
+        results.append((item["token_value"], pii_identified, identified_tokens))
+
+    return results
+
+
+def tokenisation_mask_call(content):
+    return tokenisation_mask_batch_call([content])[0]
+
+
+def tokenisation_unmask_call(masked_content):
+    logger.info(f"Begin unmask_api call with {masked_content}")
     try:
-        for data in response.json()["data"][0]["individual_tokens"]:
-            identified_tokens.append({"key": data['prefix'] + data['token'] + data['suffix']})
-            pii_identified.append(data["value"])
+        result = tokenisation_client.unmask([masked_content])
     except Exception as e:
-        pass
+        logger.error(f"Error in unmask api call - {str(e)}")
+        raise e
+    logger.info(f"End unmask_api call response {result}")
+    return result.json()["data"][0]["value"]
+
+
+def get_cache_tenant():
+    # tokens are only meaningful inside one vault, so by default the vault is the tenant
+    if COMPLETION_CACHE_TENANT_HEADER:
+        return request.headers.get(COMPLETION_CACHE_TENANT_HEADER)
+    return hashlib.sha256(str(TOKENISATION_TOKEN).encode("utf-8")).hexdigest()
+
+
+def chat_completion(params, tenant=None, deadline=None, estimated_tokens=0):
+    cache_key = None
+    prompt_key = CompletionCache.key(tenant, params) if tenant else None
+    if completion_cache and prompt_key and completion_cache.is_cacheable(params):
+        cache_key = prompt_key
+        completion = completion_cache.get(cache_key)
+        if completion is not None:
+            metrics.increment("completion_cache.hit")
+            logger.info("End openai_api call served from completion cache")
+            return replay_completion(completion, params["stream"])
+        metrics.increment("completion_cache.miss")
+
+    reserve = UNMASK_RESERVE_SECONDS if tenant else 0
+
+    def create():
+        # only calls that really reach OpenAI draw from the quota, cache hits and followers do not
+        if admission_controller:
+            admission_controller.admit(estimated_tokens, deadline)
+        started_at = time.monotonic()
+        response = openai_client.create_chat_completion(params, deadline, reserve)
+        latency = time.monotonic() - started_at
+        metrics.observe(f"openai.latency.{params['model']}", latency)
+        logger.info(f"End openai_api call model={params['model']} latency={latency:.3f}s")
+        return response
+
+    if single_flight and prompt_key:
+        flight_key = f"{prompt_key}:{'stream' if params['stream'] else 'full'}"
+        response = single_flight.do(flight_key, create, params["stream"], deadline)
+    else:
+        response = create()
+    if cache_key:
+        if params["stream"]:
+            return record_stream(response, lambda completion: completion_cache.set(cache_key, completion))
+        if response.choices[0].finish_reason == "stop":
+            completion_cache.set(cache_key, response.to_dict_recursive())
+    return response
+
+
+def summarise_history(summary, messages):
+    encoding = get_encoding(OPENAI_MODEL)
+    # history that was already too long for one prompt is summarised from its newest messages
+    messages, prompt_tokens = trim_to_budget(messages, OPENAI_MAX_TOKENS_PROMPT, encoding, token_counter)
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = [{"role": "system", "content": COMPACTION_SYSTEM_MESSAGE}]
+    if summary:
+        prompt.append({"role": "system", "content": f"{COMPACTION_SUMMARY_MESSAGE} '{summary}'"})
+    prompt.append({"role": "user", "content": transcript})
+    params = {
+        "model": OPENAI_MODEL,
+        "messages": prompt,
+        "temperature": 0,
+        "max_tokens": int(COMPACTION_MAX_TOKENS),
+        "stream": False
+    }
+    response = chat_completion(params, deadline=Deadline(REQUEST_DEADLINE_SECONDS),
+                               estimated_tokens=count_prompt_tokens(prompt, encoding, token_counter) +
+                               int(COMPACTION_MAX_TOKENS))
+    return response.choices[0].message.content
+
 
-    return masked_response, pii_identified, identified_tokens
+def remember_tokens(identified_tokens, pii_identified):
+    email = request.headers.get("email")
+    if email:
+        token_store.save(email, identified_tokens, pii_identified)
+
+
+def get_token_map(request_body, history):
+    conversation_id = request_body.get("conversation_id")
+    if conversation_id in (None, "", "None"):
+        token_map = TokenMap()
+    else:
+        token_map = conversation_token_maps.get((request.headers.get("email"), str(conversation_id)))
+        if not len(token_map) and postgres_db_client and request_body.get("user_id"):
+            try:
+                for tokens, pii in postgres_db_client.get_identified_tokens(conversation_id,
+                                                                            request_body["user_id"]):
+                    token_map.add(tokens, pii)
+            except Exception as e:
+                logger.warning(f"Unable to load token map for conversation {conversation_id} - {str(e)}")
+
+    # turns loaded from openai_chat.messages carry the tokens they were masked with
+    for message in history:
+        token_map.add(message.get("identified_tokens"), message.get("identified_pii"))
+    return token_map
+
+
+def unmask_remaining(user, token_map, text):
+    # placeholders this conversation has not seen may still come from the user's uploads, other conversations
+    # or turns handled by another worker
+    content, unknown_tokens = token_map.unmask(text)
+    if user:
+        found = token_store.resolve(user, unknown_tokens)
+        if found:
+            token_map.add(list(found), list(found.values()))
+            content, unknown_tokens = token_map.unmask(content)
+    if unknown_tokens:
+        logger.info(f"Local unmask missed {len(unknown_tokens)} tokens, falling back to unmask_api")
+        content = tokenisation_unmask_call(content)
+    return content
+
+
+def unmask_response(masked_content, token_map, user):
+    content, unknown_tokens = token_map.unmask(masked_content)
+    if unknown_tokens:
+        content = unmask_remaining(user, token_map, content)
+    return content
+
+
+def frame_document_prompt(document, messages):
+    if document is None:
+        return []
+    if document_retriever:
+        # only the parts of the document relevant to the latest question go into the prompt
+        query = next((message["content"] for message in reversed(messages) if message["role"] == "user"), "")
+        document = document_retriever.excerpt(document, query)
+    return [
+        {
+            "role": "system",
+            "content": f"{OPENAI_PDF_SYSTEM_MESSAGE} '{document}'"
+        }
+    ]
 
 
 def frame_structure_for_public(messages_):
     messages = []
-    system_prompt = []
+    document = None
 
     for message in messages_:
         if message["is_file_data"]:
-            system_prompt = [
-                {
-                    "role": "system",
-                    "content": f"{OPENAI_PDF_SYSTEM_MESSAGE} '{message['content']}'"
-                }
-            ]
+            document = message['content']
             messages = []
         else:
             messages.append({
                 "role": message["role"],
                 "content": message["content"]
             })
-    return system_prompt, messages
+    return frame_document_prompt(document, messages), messages
 
 
-def frame_structure_for_private(messages_):
+def frame_structure_for_private(messages_, token_map=None):
     messages = []
-    system_message = []
+    document = None
     pii_identified = []
     identified_tokens = []
     masked_content_user = ""
 
-    for message in messages_:
-
-        if message["masked_content"] is None:
-            if message["is_file_data"]:
-                content = message["content"]
-                masked_response = message["content"]
-                system_message = [
-                    {
-                        "role": "system",
-                        "content": f"{OPENAI_PDF_SYSTEM_MESSAGE} '{content}'"
-                    }
-                ]
-                messages = []
-            else:
-                logger.info(f"Begin - mask_api call with {message['content']}")
-                masked_response, pii_identified, identified_tokens = tokenisation_mask_call(message["content"])
-                logger.info(f"End - mask_api call response {message['content']}")
+    # mask every message that has no masked content yet in a single round trip
+    pending = [message for message in messages_ if message["masked_content"] is None]
+    if pending:
+        logger.info(f"Begin - mask_api batch call with {len(pending)} messages")
+        mask_results = tokenisation_mask_batch_call([message["content"] for message in pending])
+        logger.info(f"End - mask_api batch call with {len(pending)} messages")
+        for message, (masked_response, pii, tokens) in zip(pending, mask_results):
+            message["masked_content"] = masked_response
+            message["identified_pii"] = pii
+            message["identified_tokens"] = tokens
+            if token_map is not None:
+                token_map.add(tokens, pii)
+                remember_tokens(tokens, pii)
+            if message["role"] == "user" and not message["is_file_data"]:
                 masked_content_user = masked_response
-                messages.append({
-                    "role": message["role"],
-                    "content": masked_response
-                })
-        else:
-
-            if message["is_file_data"]:
-                system_message = [
-                    {
-                        "role": "system",
-                        "content": f"{OPENAI_PDF_SYSTEM_MESSAGE} '{message['masked_content']}'"
-                    }
-                ]
-                messages = []
+                pii_identified = pii
+                identified_tokens = tokens
 
-            else:
-                messages.append({
-                    "role": message["role"],
-                    "content": message["masked_content"]
-                })
-    return system_message, messages, masked_content_user, pii_identified, identified_tokens
+    for message in messages_:
+        if message["is_file_data"]:
+            document = message['masked_content']
+            messages = []
+        else:
+            messages.append({
+                "role": message["role"],
+                "content": message["masked_content"]
+            })
+    return (frame_document_prompt(document, messages), messages, masked_content_user, pii_identified,
+            identified_tokens)
 
 
 def get_messages(request_body):
@@ -242,38 +759,95 @@ def get_messages(request_body):
                               "masked_content": None})
         else:
             m.append({"role": "user", "content": user_msg["content"], "is_file_data": False,
-                      "masked_content": msg["masked_content_user"]})
+                      "masked_content": msg.get("masked_content_user"),
+                      "identified_tokens": user_msg.get("identified_tokens"),
+                      "identified_pii": user_msg.get("identified_pii")})
             m.append({"role": "assistant", "content": msg["content"], "is_file_data": False,
-                      "masked_content": msg["masked_content_assistant"]})
+                      "masked_content": msg.get("masked_content_assistant"),
+                      "identified_tokens": msg.get("identified_tokens"),
+                      "identified_pii": msg.get("identified_pii")})
     messages_ = m
     return messages_
 
 
+def save_turn(request_body, new_messages, content, masked_content):
+    turn = new_messages + [{"role": "assistant", "content": content, "is_file_data": False,
+                            "masked_content": masked_content}]
+    try:
+        conversation_store.append(request_body.get("user_id"), request_body["conversation_id"], turn)
+    except IntegrityError as e:
+        # the cached user id no longer exists, so the next request resolves it again
+        logger.error(f"Unable to save turn for conversation {request_body['conversation_id']} - {str(e)}")
+        metrics.increment("conversation_state.save_failed")
+        if user_directory and request_body.get("email"):
+            user_directory.invalidate(request_body["email"])
+    except Exception as e:
+        logger.error(f"Unable to save turn for conversation {request_body['conversation_id']} - {str(e)}")
+        metrics.increment("conversation_state.save_failed")
+
+
 def conversation_without_data(request_body):
     pii_identified = []
     identified_tokens = []
     masked_content_user = ""
 
     logger.info("Begin conversation_without_data")
-    openai.api_key = OPENAI_API_KEY
+    deadline = Deadline(REQUEST_DEADLINE_SECONDS)
 
     user_filter = request_body["filter"]
     is_file_uploaded = request_body["isFileUploaded"]
 
     messages_ = get_messages(request_body)
+    new_messages = None
+    history = []
+    if request_body.get("delta"):
+        if not conversation_store:
+            raise Exception("Delta requests need the conversation history store")
+        new_messages = messages_
+        history = conversation_store.load(request_body["conversation_id"], request_body.get("user_id"))
+        messages_ = history + new_messages
 
     if user_filter == "private":
+        token_map = get_token_map(request_body, history)
         system_message, messages, masked_content_user, pii_identified, identified_tokens = (
-            frame_structure_for_private(messages_))
+            frame_structure_for_private(messages_, token_map))
     else:
         system_message, messages = frame_structure_for_public(messages_)
 
-    token_length_flag = True
-    while token_length_flag:
-        if int(OPENAI_MAX_TOKENS_PROMPT) < num_tokens_from_string(str(messages), OPENAI_MODEL):
-            messages = messages[1:]
-        else:
-            token_length_flag = False
+    if not is_file_uploaded:
+        system_message = []
+
+    conversation_id = request_body.get("conversation_id")
+    if history_compactor and conversation_id and conversation_id != "None":
+        summary, messages = history_compactor.compact(conversation_id, messages)
+        if summary:
+            system_message = system_message + [
+                {
+                    "role": "system",
+                    "content": f"{COMPACTION_SUMMARY_MESSAGE} '{summary}'"
+                }
+            ]
+
+    encoding = get_encoding(OPENAI_MODEL)
+    system_tokens = sum(count_message_tokens(message, encoding, token_counter) for message in system_message)
+
+    model = OPENAI_MODEL
+    prompt_budget = int(OPENAI_MAX_TOKENS_PROMPT)
+    if model_router:
+        # route on the untrimmed prompt, history is only dropped when even the largest model cannot hold it
+        decision = model_router.choose(count_prompt_tokens(messages, encoding, token_counter) + system_tokens,
+                                       int(OPENAI_MAX_TOKENS))
+        model = decision.route.model
+        if model != OPENAI_MODEL:
+            # the routed model may tokenise differently, so its budget is counted in its own encoding
+            encoding = get_encoding(model)
+            system_tokens = sum(count_message_tokens(message, encoding, token_counter) for message in system_message)
+        prompt_budget = decision.route.context_window - int(OPENAI_MAX_TOKENS) - system_tokens
+        logger.info(f"Routing decision - {decision}")
+        metrics.increment(f"routing.{model}.{'fits' if decision.fits else 'trimmed'}")
+
+    messages, prompt_tokens = trim_to_budget(messages, prompt_budget, encoding, token_counter)
+    logger.info(f"Prompt holds {len(messages)} messages and {prompt_tokens} tokens")
 
     if messages:
         pass
@@ -281,21 +855,22 @@ def conversation_without_data(request_body):
         logger.error(f"Prompt limit exceeded,shorten your prompt")
         raise Exception("Prompt size limit exceeded")
 
-    if is_file_uploaded:
-        messages = system_message + messages
+    messages = system_message + messages
+    prompt_tokens += system_tokens
     logger.info(f"Begin openai_api call with {messages}")
-    response = openai.ChatCompletion.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        temperature=float(OPENAI_TEMPERATURE),
-        max_tokens=int(OPENAI_MAX_TOKENS),
-        top_p=float(OPENAI_TOP_P),
-        stop=OPENAI_STOP_SEQUENCE.split("|") if OPENAI_STOP_SEQUENCE else None,
-        stream=bool(SHOULD_STREAM),
-        frequency_penalty=0,
-        presence_penalty=0
-    )
-    logger.info(f"End openai_api response with {response.choices[0].message.content}")
+    completion_params = {
+        "model": model,
+        "messages": messages,
+        "temperature": float(OPENAI_TEMPERATURE),
+        "max_tokens": int(OPENAI_MAX_TOKENS),
+        "top_p": float(OPENAI_TOP_P),
+        "stop": OPENAI_STOP_SEQUENCE.split("|") if OPENAI_STOP_SEQUENCE else None,
+        "stream": bool(SHOULD_STREAM),
+        "frequency_penalty": 0,
+        "presence_penalty": 0
+    }
+    response = chat_completion(completion_params, get_cache_tenant() if user_filter == "private" else None,
+                               deadline, prompt_tokens + int(OPENAI_MAX_TOKENS))
 
     history_metadata = {
         "conversation_id": request_body["conversation_id"],
@@ -304,27 +879,18 @@ def conversation_without_data(request_body):
     }
 
     if not SHOULD_STREAM:
+        logger.info(f"End openai_api response with {response.choices[0].message.content}")
         if user_filter == 'private':
             masked_assistant_response = response.choices[0].message.content
-            payload = {"unmask": [{"token_value": masked_assistant_response}]}
-            headers = {
-                "Authorization": f"Bearer {TOKENISATION_TOKEN}",
-                "Content-Type": "application/json"
-            }
-            logger.info(f"Begin unmask_api call with {masked_assistant_response}")
-            try:
-                result = requests.put(TOKENISATION_UNMASK_URL, json=payload, headers=headers)
-            except Exception as e:
-                logger.error(f"Error in unmask api call - {str(e)}")
-                raise e
-            logger.info(f"End unmask_api call response {result}")
-            content_response = result.json()["data"][0]["value"]
+            content_response = unmask_response(masked_assistant_response, token_map, request.headers.get("email"))
         else:
             content_response = response.choices[0].message.content
             masked_assistant_response = None
+        if new_messages is not None:
+            save_turn(request_body, new_messages, content_response, masked_assistant_response)
 
         response_obj = {
-            "id": response,
+            "id": response.id,
             "model": response.model,
             "created": response.created,
             "object": response.object,
@@ -342,9 +908,21 @@ def conversation_without_data(request_body):
             "history_metadata": history_metadata
         }
         logger.info("End conversation_without_data")
-        return jsonify(response_obj), 200
+        return json_response(select_fields(response_obj, get_response_fields()), 200)
     else:
-        return Response(stream_without_data(response, history_metadata), mimetype='text/event-stream')
+        message_fields = {
+            "masked_content_user": masked_content_user,
+            "identified_pii": pii_identified,
+            "identified_tokens": identified_tokens
+        }
+        unmasker = None
+        if user_filter == 'private':
+            unmasker = StreamingUnmasker(token_map, partial(unmask_remaining, request.headers.get("email"), token_map))
+        cumulative = request_body.get("stream_format", STREAM_FORMAT) == "cumulative"
+        on_complete = partial(save_turn, request_body, new_messages) if new_messages is not None else None
+        return Response(stream_without_data(response, history_metadata, unmasker, message_fields, cumulative,
+                                            on_complete, get_response_fields()),
+                        mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
 
 
 @app.route("/conversation", methods=["GET", "POST"])
@@ -356,6 +934,20 @@ def conversation():
 def conversation_internal(request_body):
     try:
         return conversation_without_data(request_body)
+    except DeadlineExceeded as e:
+        logger.error(f"Error in conversation_internal - {str(e)}")
+        return jsonify({"error": str(e)}), 504
+    except ConversationAccessDenied as e:
+        logger.warning(f"Conversation of another user requested - {str(e)}")
+        return jsonify({"error": str(e)}), 404
+    except AdmissionRejected as e:
+        logger.warning(f"Request shed by admission control - {str(e)}")
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
+    except openai.error.RateLimitError as e:
+        # Retry-After takes whole seconds, and a sub-second hint must not tell the client to retry at once
+        retry_after = max(1, math.ceil(OpenAIClient.retry_after(e) or 1))
+        logger.warning(f"OpenAI rate limit reached - {str(e)}")
+        return jsonify({"error": str(e), "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
     except Exception as e:
         logging.exception("Exception in /conversation")
         logger.error(traceback.format_exc())
@@ -363,6 +955,11 @@ def conversation_internal(request_body):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return json_response(metrics.snapshot(), 200)
+
+
 @app.route("/menus", methods=["GET"])
 def menus():
     logger.info("request received- /menus")
@@ -423,7 +1020,7 @@ def upload_file():
             pass
         else:
             email = request.headers['email']
-            postgres_db_client.create_user(email)
+            user_directory.get_user_id(email)
 
         if 'pdfFile' not in request.files:
             return jsonify({'error': 'No file provided'}), 400
@@ -459,8 +1056,21 @@ def upload_file():
 
         delete_files_in_directory("uploaded_files")
 
+        if UPLOAD_MAX_TOKENS and num_tokens_from_string(text, OPENAI_MODEL) > int(UPLOAD_MAX_TOKENS):
+            logger.warning(f"Uploaded file exceeds {UPLOAD_MAX_TOKENS} tokens - {pdf_path}")
+            return jsonify({
+                "fileInvalid": {
+                    "message": os.environ.get("ERROR_MESSAGE_FOR_LARGE_FILE",
+                                              "The uploaded file is too large. Please try a shorter PDF file.")
+                },
+                "success": True,
+                "error": {
+                    "message": "File exceeds the token limit"
+                }
+            })
+
         if text_filter == "public":
-            return jsonify({"data": {
+            return json_response({"data": {
                 "text": text
             },
                 "success": True,
@@ -469,8 +1079,11 @@ def upload_file():
                 },
             })
         else:
-            masked_text, pii, tokens = tokenisation_mask_call(text)
-            return jsonify({"data": {
+            masked_text, pii, tokens = mask_in_chunks(text, tokenisation_mask_call,
+                                                      MASK_CHUNK_MAX_CHARS, MASK_CHUNK_CONCURRENCY)
+            # replies quoting the document are unmasked locally, whichever conversation it is sent in
+            remember_tokens(tokens, pii)
+            return json_response({"data": {
                 "text": masked_text,
                 "identified_tokens": tokens
             },
@@ -491,18 +1104,42 @@ def upload_file():
 @app.route("/history/generate", methods=["POST"])
 def add_conversation():
     logger.info("request received- /generate")
+    if not scheduler:
+        return generate_conversation()
+
+    user = request.headers.get('email') or request.remote_addr
+    try:
+        release = scheduler.enter(user)
+    except QueueRejected as e:
+        logger.warning(f"Request shed by scheduler for {user} - {str(e)}")
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
+
+    try:
+        result = generate_conversation()
+    except Exception:
+        release()
+        raise
+    if isinstance(result, Response) and result.is_streamed:
+        result.call_on_close(release)
+    else:
+        release()
+    return result
+
+
+def generate_conversation():
     if not postgres_db_client:
         request_body = request.json
         return conversation_internal(request_body)
     else:
         email = request.headers['email']
-        postgres_db_client.create_user(email)
-        user_id = postgres_db_client.get_user_id(email)
+        user_id = user_directory.get_user_id(email)
         # check request for conversation_id
         logger.info(f"User id: {user_id} t Api: history/generate")
         try:
             conversation_id = request.json.get("conversation_id", None)
             # check for the conversation_id, if the conversation is not set, we will create a new one
+            if conversation_id in (None, "", "None"):
+                conversation_id = uuid.uuid4()
             messages = request.json["messages"]
             if len(messages) > 0 and messages[-1]['role'] == "user":
                 pass
@@ -512,7 +1149,8 @@ def add_conversation():
             # Submit request to Chat Completions for response
             request_body = request.json
             request_body["conversation_id"] = str(conversation_id)
-            postgres_db_client.update_interaction(user_id)
+            request_body["user_id"] = user_id
+            request_body["email"] = email
             return conversation_internal(request_body)
 
         except Exception as e:
@@ -522,6 +1160,39 @@ def add_conversation():
             return response, 500
 
 
+@app.route("/history/delete_all", methods=["DELETE"])
+def delete_all_conversations():
+    if not postgres_db_client:
+        return jsonify({"error": "Conversation history is not configured"}), 404
+    try:
+        email = request.headers['email']
+        user_id = user_directory.get_user_id(email)
+        # conversations and their messages go in a single statement, however many there are
+        deleted = postgres_db_client.delete_all_conversations(user_id)
+        logger.info(f"Deleted {len(deleted)} conversations for user {user_id}")
+        return jsonify({"message": "Successfully deleted conversations and messages for user",
+                        "conversation_ids": deleted}), 200
+    except Exception as e:
+        logger.error(f"Exception in /history/delete_all Error - {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/history/delete_user", methods=["DELETE"])
+def delete_user():
+    if not postgres_db_client:
+        return jsonify({"error": "Conversation history is not configured"}), 404
+    try:
+        email = request.headers['email']
+        if not user_directory.delete_user(email):
+            return jsonify({"error": "User not found"}), 404
+        return jsonify({"message": "Successfully deleted user and conversation history"}), 200
+    except Exception as e:
+        logger.error(f"Exception in /history/delete_user Error - {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/history/ensure", methods=["GET"])
 def ensure_postgres():
     return jsonify({"message": "PostgresDB is configured and working"}), 200
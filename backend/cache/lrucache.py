@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None, sizeof=None):
+        self.__lock = threading.Lock()
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl) if ttl else None
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.sizeof = sizeof or (lambda value: 0)
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.__lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl if ttl else None, size)
+            self.size_bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.__lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.entries.clear()
+            self.size_bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size_bytes -= size
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "size_bytes": self.size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
@@ -0,0 +1,22 @@
+import os
+import threading
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def get_redis_client(redis_url):
+    # redis is optional: without REDIS_URL every cache and limiter stays local to the worker
+    if not redis_url:
+        return None
+    key = (redis_url, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import redis
+                client = redis.Redis.from_url(redis_url, socket_timeout=1, socket_connect_timeout=1,
+                                              health_check_interval=30)
+                _clients[key] = client
+    return client
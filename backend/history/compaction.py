@@ -0,0 +1,104 @@
+import hashlib
+import json
+import logging
+import threading
+
+from backend.cache.lrucache import TTLCache
+
+logger = logging.getLogger("my_logger")
+
+
+def history_digest(messages):
+    # identifies the exact prefix a summary was built from, so edited or regenerated history is never summarised
+    payload = json.dumps([[message["role"], message["content"]] for message in messages], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LocalSummaryStore:
+
+    def __init__(self, max_entries=1000):
+        self.summaries = TTLCache(max_entries=max_entries)
+
+    def get_conversation_summary(self, conversation_id):
+        return self.summaries.get(str(conversation_id))
+
+    def upsert_conversation_summary(self, conversation_id, summary, compacted_count, history_digest):
+        self.summaries.set(str(conversation_id), {"summary": summary,
+                                                  "compacted_count": compacted_count,
+                                                  "history_digest": history_digest})
+
+
+class HistoryCompactor:
+
+    def __init__(self, store, summarise, submit, trigger_messages=12, keep_recent=6, metrics=None):
+        self.store = store
+        # summaries the store failed to save stay in this worker, so they are not paid for again on every request
+        self.fallback = LocalSummaryStore()
+        self.summarise = summarise
+        self.submit = submit
+        self.trigger_messages = int(trigger_messages)
+        # the latest user message is never folded away
+        self.keep_recent = max(int(keep_recent), 1)
+        self.metrics = metrics
+        self.__lock = threading.Lock()
+        self.pending = set()
+
+    def compact(self, conversation_id, messages):
+        """Returns the stored summary (or None) and the messages it does not cover yet."""
+        summary, compacted_count = None, 0
+        try:
+            record = self.store.get_conversation_summary(conversation_id)
+        except Exception as e:
+            logger.warning(f"Conversation summary lookup failed for {conversation_id} - {str(e)}")
+            record = None
+        local = self.fallback.get_conversation_summary(conversation_id)
+        if local and (record is None or local["compacted_count"] > record["compacted_count"]):
+            record = local
+        if (record and record["compacted_count"] < len(messages)
+                and record["history_digest"] == history_digest(messages[:record["compacted_count"]])):
+            summary, compacted_count = record["summary"], record["compacted_count"]
+            self.increment("compaction.applied")
+
+        recent = messages[compacted_count:]
+        if len(recent) > self.trigger_messages:
+            self.schedule(conversation_id, summary, messages, compacted_count)
+        return summary, recent
+
+    def schedule(self, conversation_id, summary, messages, compacted_count):
+        with self.__lock:
+            if conversation_id in self.pending:
+                return
+            self.pending.add(conversation_id)
+        try:
+            self.submit(self.refresh, conversation_id, summary, list(messages), compacted_count)
+        except Exception:
+            self.finish(conversation_id)
+            raise
+
+    def refresh(self, conversation_id, summary, messages, compacted_count):
+        try:
+            new_count = len(messages) - self.keep_recent
+            if new_count <= compacted_count:
+                return
+            summary = self.summarise(summary, messages[compacted_count:new_count])
+            digest = history_digest(messages[:new_count])
+            try:
+                self.store.upsert_conversation_summary(conversation_id, summary, new_count, digest)
+            except Exception as e:
+                logger.warning(f"Conversation summary could not be stored for {conversation_id} - {str(e)}")
+                self.increment("compaction.store_failed")
+                self.fallback.upsert_conversation_summary(conversation_id, summary, new_count, digest)
+            self.increment("compaction.refreshed")
+        except Exception as e:
+            logger.error(f"Conversation summary refresh failed for {conversation_id} - {str(e)}")
+            self.increment("compaction.failed")
+        finally:
+            self.finish(conversation_id)
+
+    def finish(self, conversation_id):
+        with self.__lock:
+            self.pending.discard(conversation_id)
+
+    def increment(self, name):
+        if self.metrics:
+            self.metrics.increment(name)
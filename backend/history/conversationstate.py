@@ -0,0 +1,67 @@
+import ast
+import uuid
+
+from backend.cache.lrucache import TTLCache
+
+DEFAULT_TITLE = "New Conversation"
+
+
+class ConversationAccessDenied(Exception):
+    pass
+
+
+def parse_identified(value):
+    try:
+        return ast.literal_eval(value) if value else None
+    except (ValueError, SyntaxError):
+        return None
+
+
+def from_row(row):
+    return {
+        "role": row["role"],
+        "content": row["content"],
+        "is_file_data": bool(row["is_file_data"]),
+        # uploaded files are already masked by /upload-file before the client sends them
+        "masked_content": row["masked_content"] or (row["content"] if row["is_file_data"] else None),
+        "identified_tokens": parse_identified(row["tokens_identified"]),
+        "identified_pii": parse_identified(row["pii_identified"])
+    }
+
+
+class ConversationStore:
+
+    def __init__(self, database, max_entries=1000, ttl=900):
+        self.database = database
+        self.cache = TTLCache(max_entries=max_entries, ttl=ttl)
+
+    def load(self, conversation_id, user_id):
+        """Returns the stored turns of one of the user's conversations, oldest first, as get_messages builds them."""
+        key = str(uuid.UUID(str(conversation_id)))
+        conversation = self.database.get_conversation(key)
+        if conversation is None:
+            return []
+        if str(conversation["user_id"]) != str(user_id):
+            raise ConversationAccessDenied(f"Conversation {key} not found")
+        # updated_at is touched on every insert, so it tells whether another worker added turns since
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != conversation["updated_at"]:
+            entry = (conversation["updated_at"], [from_row(row) for row in self.database.get_messages(key)])
+            self.cache.set(key, entry)
+        return [dict(message) for message in entry[1]]
+
+    def append(self, user_id, conversation_id, messages):
+        key = str(uuid.UUID(str(conversation_id)))
+        entry = self.cache.get(key)
+        rows = self.database.create_turn(user_id, key, messages, DEFAULT_TITLE)
+        if not rows:
+            raise ConversationAccessDenied(f"Conversation {key} not found")
+        inserted = [row for row in rows if row["message_id"] is not None]
+        if entry is not None and len(inserted) == len(messages):
+            self.cache.set(key, (rows[0]["conversation_updated_at"],
+                                 entry[1] + [dict(message) for message in messages]))
+        else:
+            self.cache.delete(key)
+
+    def stats(self):
+        return self.cache.stats()
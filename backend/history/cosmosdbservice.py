@@ -4,7 +4,10 @@ from datetime import datetime
 from flask import Flask, request
 from azure.identity import DefaultAzureCredential  
 from azure.cosmos import CosmosClient, PartitionKey  
-  
+
+## a transactional batch holds at most 100 operations, all in one partition
+BATCH_MAX_OPERATIONS = 100
+
 class CosmosConversationClient():
     
     def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str):
@@ -62,14 +65,48 @@ class CosmosConversationClient():
 
         
     def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = self.get_messages(user_id, conversation_id)
+        ## only the ids are needed, and the query stays inside the user's partition
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = ("SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' "
+                 "AND c.userId = @userId")
+        message_ids = [item['id'] for item in self.container_client.query_items(query=query, parameters=parameters,
+                                                                              partition_key=user_id)]
+        if message_ids:
+            return self.delete_items(message_ids, user_id)
+
+    def delete_all_conversations(self, user_id):
+        ## conversations and their messages all live in the user's partition
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id FROM c WHERE c.userId = @userId AND (c.type='conversation' OR c.type='message')"
+        item_ids = [item['id'] for item in self.container_client.query_items(query=query, parameters=parameters,
+                                                                           partition_key=user_id)]
+        return self.delete_items(item_ids, user_id)
+
+    def delete_items(self, item_ids, partition_key):
+        execute_item_batch = getattr(self.container_client, "execute_item_batch", None)
+        if execute_item_batch is None:
+            ## azure-cosmos before 4.6 has no transactional batch
+            return [self.container_client.delete_item(item=item_id, partition_key=partition_key)
+                    for item_id in item_ids]
         response_list = []
-        if messages:
-            for message in messages:
-                resp = self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+        for start in range(0, len(item_ids), BATCH_MAX_OPERATIONS):
+            batch_operations = [("delete", (item_id,)) for item_id in item_ids[start:start + BATCH_MAX_OPERATIONS]]
+            response_list.extend(execute_item_batch(batch_operations=batch_operations, partition_key=partition_key))
+        return response_list
 
 
     def get_conversations(self, user_id, sort_order = 'DESC'):
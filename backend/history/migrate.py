@@ -0,0 +1,138 @@
+import argparse
+import logging
+import os
+import re
+import sys
+import uuid
+
+from sqlalchemy import text
+
+from backend.history.statements import statements
+
+logger = logging.getLogger("my_logger")
+
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE_PATTERN = re.compile(r"^(\d{4})_(\w+)\.sql$")
+# any constant works as long as every runner uses the same one
+MIGRATION_LOCK_KEY = 7251013
+
+# hot path history queries and the index each of them should be planned with
+INDEXED_QUERIES = {
+    "get_messages": "messages_conversation_id_created_at_idx",
+    "get_conversations_asc": "conversations_user_id_updated_at_idx",
+    "get_conversations_desc": "conversations_user_id_updated_at_idx",
+}
+
+
+class Migration:
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def read(self):
+        with open(self.path, encoding="utf-8") as file:
+            return file.read()
+
+
+def load_migrations(directory=MIGRATIONS_DIRECTORY):
+    migrations = []
+    for file_name in os.listdir(directory):
+        match = MIGRATION_FILE_PATTERN.match(file_name)
+        if match:
+            migrations.append(Migration(int(match.group(1)), match.group(2), os.path.join(directory, file_name)))
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+class MigrationRunner:
+
+    def __init__(self, engine, directory=MIGRATIONS_DIRECTORY):
+        self.engine = engine
+        self.directory = directory
+
+    def run(self):
+        """Applies the pending migrations in version order and returns them."""
+        migrations = load_migrations(self.directory)
+        # one transaction for the whole run: a failed migration leaves the schema and the version table untouched
+        with self.engine.begin() as connection:
+            # concurrent deploys or workers wait here and then find nothing left to apply
+            connection.execute(text("select pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            connection.exec_driver_sql("CREATE SCHEMA IF NOT EXISTS openai_chat")
+            connection.exec_driver_sql("CREATE TABLE IF NOT EXISTS openai_chat.schema_migrations "
+                                       "(version integer NOT NULL PRIMARY KEY, name character varying NOT NULL, "
+                                       "applied_at timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL)")
+            applied = {row[0] for row in connection.execute(text("select version from openai_chat.schema_migrations"))}
+            pending = [migration for migration in migrations if migration.version not in applied]
+            for migration in pending:
+                logger.info(f"Applying migration {migration.version:04d}_{migration.name}")
+                connection.exec_driver_sql(migration.read())
+                connection.execute(text("insert into openai_chat.schema_migrations(version, name) "
+                                        "values (:version, :name)"),
+                                   {"version": migration.version, "name": migration.name})
+        return pending
+
+
+def plan_index_names(plan):
+    names = set()
+    if isinstance(plan, dict):
+        if "Index Name" in plan:
+            names.add(plan["Index Name"])
+        for value in plan.values():
+            names |= plan_index_names(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            names |= plan_index_names(value)
+    return names
+
+
+def check_history_indexes(engine):
+    """Returns {statement name: problem} for the history queries that are not planned with their index."""
+    problems = {}
+    sample = str(uuid.UUID(int=0))
+    with engine.begin() as connection:
+        # small tables are cheaper to scan, so take that option away and ask whether the index is usable at all
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        for name, index_name in INDEXED_QUERIES.items():
+            statement = statements[name]
+            values = {parameter: sample for parameter in statement.parameters}
+            plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {statement.sql}"), values).scalar()
+            used = plan_index_names(plan)
+            if index_name not in used:
+                problems[name] = f"expected {index_name}, plan uses {sorted(used) or 'no index'}"
+    return problems
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    from backend.history.postgresdbservice import Database
+
+    parser = argparse.ArgumentParser(description="Apply the pending openai_chat schema migrations")
+    parser.add_argument("--check", action="store_true",
+                        help="afterwards EXPLAIN the history queries and fail unless they use their indexes")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    Database.get_or_initialize_connection_pool(os.environ.get("POSTGRES_USER"), os.environ.get("POSTGRES_PASSWORD"),
+                                               os.environ.get("POSTGRES_HOST"), os.environ.get("POSTGRES_DATABASE"))
+    engine = Database.db_connection_pool
+    applied = MigrationRunner(engine).run()
+    print(f"Applied {len(applied)} migration(s)" +
+          "".join(f"\n  {migration.version:04d}_{migration.name}" for migration in applied))
+
+    if args.check:
+        problems = check_history_indexes(engine)
+        for name, problem in problems.items():
+            print(f"{name}: {problem}")
+        if problems:
+            return 1
+        print("History queries use their indexes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,7 @@
+-- get_messages filters on conversation_id and sorts on created_at
+CREATE INDEX IF NOT EXISTS messages_conversation_id_created_at_idx
+    ON openai_chat.messages (conversation_id, created_at);
+
+-- get_conversations filters on user_id and sorts on updated_at, in either direction
+CREATE INDEX IF NOT EXISTS conversations_user_id_updated_at_idx
+    ON openai_chat.conversations (user_id, updated_at);
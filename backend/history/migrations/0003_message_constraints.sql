@@ -0,0 +1,4 @@
+-- NOT VALID enforces both checks on new rows without scanning, or discarding, the rows already stored;
+-- run VALIDATE CONSTRAINT once any message without a conversation has been dealt with
+ALTER TABLE openai_chat.messages DROP CONSTRAINT IF EXISTS messages_conversation_id_check, ADD CONSTRAINT messages_conversation_id_check CHECK (conversation_id IS NOT NULL) NOT VALID;
+ALTER TABLE openai_chat.messages DROP CONSTRAINT IF EXISTS messages_role_check, ADD CONSTRAINT messages_role_check CHECK (role IN ('system', 'user', 'assistant')) NOT VALID;
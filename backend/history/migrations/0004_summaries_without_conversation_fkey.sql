@@ -0,0 +1,3 @@
+-- summaries are also written for conversations that have no row in openai_chat.conversations
+ALTER TABLE openai_chat.conversation_summaries
+    DROP CONSTRAINT IF EXISTS conversation_summaries_conversation_id_fkey;
@@ -1,9 +1,15 @@
+import ast
+import json
 import threading
+import time
 import uuid
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, class_mapper
 
+from backend.history.statements import statements
+from backend.monitoring.metrics import metrics
+
 
 class Database:
     __singleton_lock = threading.Lock()
@@ -11,10 +17,12 @@ class Database:
     session_maker = None
     db_connection_pool = None
 
-    def __init__(self, user, password, host, database):
+    def __init__(self, user, password, host, database, prepared_statements=True):
+        # server side PREPARE does not survive transaction pooling (e.g. pgbouncer), so it can be turned off
+        self.prepared_statements = prepared_statements
         try:
             Database.get_or_initialize_connection_pool(user, password, host, database)
-            self.get_conversations("id")
+            self.get_conversations(str(uuid.UUID(int=0)))
             self.postgres_flag = True
         except Exception as e:
             self.postgres_flag = False
@@ -67,9 +75,47 @@ class Database:
         finally:
             self.close_session(session)
 
+    def execute_statement(self, name, values=None, with_result=False):
+        statement = statements[name]
+        session = None
+        info = None
+        result = "No result"
+        start = time.perf_counter()
+        try:
+            session = self.get_session()
+            if self.prepared_statements:
+                # prepared statements live as long as the DBAPI connection, and so does connection.info
+                info = session.connection().info
+                prepared = info.setdefault("prepared_statements", set())
+                if info.pop("deallocate_statements", False):
+                    session.execute(text("DEALLOCATE ALL"))
+                    prepared.clear()
+                if statement.name not in prepared:
+                    session.execute(statement.prepare_text)
+                    prepared.add(statement.name)
+                output = session.execute(statement.execute_text, values)
+            else:
+                output = session.execute(statement.text, values)
+            if with_result:
+                result = output.mappings().all()
+            session.commit()
+            return result
+        except Exception as e:
+            metrics.increment(f"db.{name}.errors")
+            if info is not None:
+                # the failure may be a stale plan after a schema change, so this connection prepares afresh
+                info["deallocate_statements"] = True
+            if session is not None:
+                session.rollback()
+            raise e
+        finally:
+            metrics.observe(f"db.{name}", time.perf_counter() - start)
+            if session is not None:
+                self.close_session(session)
+
     def get_conversations(self, user_id, sort_order='DESC'):
-        query = f"select * from openai_chat.conversations where user_id = '{user_id}' order by updated_at {sort_order};"
-        conversations = self.execute_query(query, with_result=True)
+        name = "get_conversations_asc" if sort_order.upper() == "ASC" else "get_conversations_desc"
+        conversations = self.execute_statement(name, values={"user_id": user_id}, with_result=True)
 
         # if no conversations are found, return None
         if len(conversations) == 0:
@@ -78,8 +124,8 @@ class Database:
             return conversations
 
     def get_conversation(self, conversation_id):
-        query = f"select * from openai_chat.conversations where conversation_id = '{conversation_id}';"
-        conversation = self.execute_query(query, with_result=True)
+        values = {"cov_id": conversation_id}
+        conversation = self.execute_statement("get_conversation", values=values, with_result=True)
 
         # if no conversations are found, return None
         if len(conversation) == 0:
@@ -90,13 +136,10 @@ class Database:
     def upsert_conversation(self, conversation, title=None):
         if title:
             values = {"title": title, "cov_id": str(conversation['conversation_id'])}
-            query = ("update openai_chat.conversations set updated_at = now(),title = :title where "
-                     "conversation_id = :cov_id")
+            resp = self.execute_statement("rename_conversation", values=values)
         else:
             values = {"cov_id": conversation['id']}
-            query = (f"update openai_chat.conversations set updated_at = now() "
-                     f"where conversation_id = :cov_id")
-        resp = self.execute_query(query, values=values)
+            resp = self.execute_statement("touch_conversation", values=values)
 
         if resp == 'No result':
             return resp
@@ -105,13 +148,10 @@ class Database:
 
     def create_conversation(self, user_id, conversation_id, title=''):
         values = {"cov_id": conversation_id, "user_id": user_id, "title": title}
-        query = ("insert into openai_chat.conversations(conversation_id,user_id,title) "
-                 "values (:cov_id,:user_id,:title);")
-        resp = self.execute_query(query, values=values)
+        resp = self.execute_statement("create_conversation", values=values)
         if resp == "No result":
             values = {"cov_id": conversation_id}
-            query = "select * from openai_chat.conversations where conversation_id = :cov_id;"
-            res = self.execute_query(query, values=values, with_result=True)
+            res = self.execute_statement("get_conversation", values=values, with_result=True)
             return res[0]
         else:
             return {}
@@ -119,14 +159,8 @@ class Database:
     def create_message(self, conversation_id, input_message: dict, is_file_data=False):
         values = {"msg_id": str(input_message['id']), "cov_id": conversation_id, "role": input_message['role'],
                   "content": input_message['content'], "is_file_data": is_file_data}
-        query = ("insert into openai_chat.messages(message_id,conversation_id,role,content,is_file_data) values"
-                 "(:msg_id,:cov_id,:role,:content,:is_file_data) ON CONFLICT (message_id) DO NOTHING;")
-        resp = self.execute_query(query, values=values)
+        resp = self.execute_statement("create_message", values=values)
         if resp:
-            # update the parent conversation's updatedAt field with the current message's createdAt datetime value
-            con = {"id": conversation_id}
-            # conversation = self.get_conversation(user_id, conversation_id)
-            self.upsert_conversation(con)
             return resp
         else:
             return False
@@ -137,24 +171,31 @@ class Database:
                   "role": input_message['role'],
                   "content": input_message['content'],
                   "masked_content": input_message['masked_content_assistant']}
-        query = ("insert into openai_chat.messages(message_id,conversation_id,role,content,masked_content) "
-                 "values(:msg_id,:cov_id,:role,:content,:masked_content);")
-
-        resp = self.execute_query(query, values=values)
+        resp = self.execute_statement("create_message_with_mask", values=values)
         if resp:
-            # update the parent conversation's updatedAt field with the current message's createdAt datetime value
-            con = {"id": conversation_id}
-            # conversation = self.get_conversation(user_id, conversation_id)
-            self.upsert_conversation(con)
             return resp
         else:
             return False
 
+    def create_turn(self, user_id, conversation_id, messages, title=''):
+        turn = [{"message_id": str(message.get("id") or uuid.uuid4()),
+                 "role": message["role"],
+                 "content": message["content"],
+                 "masked_content": message.get("masked_content"),
+                 "pii_identified": str(message["identified_pii"]) if message.get("identified_pii") else None,
+                 "tokens_identified": str(message["identified_tokens"]) if message.get("identified_tokens") else None,
+                 "is_file_data": bool(message.get("is_file_data")),
+                 "position": position} for position, message in enumerate(messages)]
+        values = {"cov_id": conversation_id, "user_id": user_id, "title": title, "messages": json.dumps(turn)}
+        # one row per inserted message: message_id, created_at and the conversation's new updated_at.
+        # when every message was already stored there is a single row with a null message_id, and when the
+        # conversation belongs to another user there is none.
+        return self.execute_statement("create_turn", values=values, with_result=True)
+
     def get_messages(self, conversation_id):
 
-        query = (f"select * from openai_chat.messages where conversation_id = '{conversation_id}' "
-                 f"order by created_at ASC;")
-        messages = self.execute_query(query, with_result=True)
+        values = {"cov_id": conversation_id}
+        messages = self.execute_statement("get_messages", values=values, with_result=True)
 
         # if no messages are found, return false
         if len(messages) == 0:
@@ -163,42 +204,69 @@ class Database:
             return messages
 
     def delete_messages(self, conversation_id, user_id):
-        # get a list of all the messages in the conversation
-        messages = self.get_messages(conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                message_id = str(message["message_id"])
-                query = f"delete from openai_chat.messages where message_id = '{message_id}';"
-                resp = self.execute_query(query)
-                response_list.append(resp)
-            return response_list
+        values = {"cov_id": conversation_id}
+        deleted = self.execute_statement("delete_messages", values=values, with_result=True)
+        if deleted:
+            return [str(message["message_id"]) for message in deleted]
 
     def delete_conversation(self, user_id, conversation_id):
         if conversation_id:
-            query = f"delete from openai_chat.conversations where conversation_id = '{conversation_id}';"
-            resp = self.execute_query(query)
+            values = {"cov_id": conversation_id}
+            resp = self.execute_statement("delete_conversation", values=values)
             return resp
         else:
             return True
 
+    def delete_all_conversations(self, user_id):
+        values = {"user_id": user_id}
+        deleted = self.execute_statement("delete_user_conversations", values=values, with_result=True)
+        return [str(conversation["conversation_id"]) for conversation in deleted]
+
     def update_message(self, message_id, content, pii_identified, identified_tokens):
         values = {"content": content, "pii_identified": str(pii_identified), "msg_id": message_id,
                   "tokens_identified": str(identified_tokens)}
-        query = ("update openai_chat.messages set masked_content = :content, pii_identified = :pii_identified, "
-                 "tokens_identified = :tokens_identified where message_id = :msg_id;")
-        resp = self.execute_query(query, values=values)
+        resp = self.execute_statement("update_message", values=values)
         return resp
 
+    def get_identified_tokens(self, conversation_id, user_id):
+        values = {"cov_id": conversation_id, "user_id": user_id}
+        rows = self.execute_statement("get_identified_tokens", values=values, with_result=True)
+        identified = []
+        for row in rows:
+            try:
+                identified.append((ast.literal_eval(row["tokens_identified"]), ast.literal_eval(row["pii_identified"])))
+            except (ValueError, SyntaxError):
+                continue
+        return identified
+
+    def get_conversation_summary(self, conversation_id):
+        values = {"cov_id": conversation_id}
+        rows = self.execute_statement("get_conversation_summary", values=values, with_result=True)
+        return dict(rows[0]) if rows else None
+
+    def upsert_conversation_summary(self, conversation_id, summary, compacted_count, history_digest):
+        values = {"cov_id": conversation_id, "summary": summary, "compacted_count": compacted_count,
+                  "history_digest": history_digest}
+        return self.execute_statement("upsert_conversation_summary", values=values)
+
     def create_user(self, email):
         user_id = uuid.uuid4()
         values = {"user_id": user_id, "email": email}
-        query = (f"INSERT INTO openai_chat.users (user_id, user_name) VALUES (:user_id, :email) "
-                 f"ON CONFLICT (user_name) DO NOTHING;")
-        resp = self.execute_query(query, values=values)
+        resp = self.execute_statement("create_user", values=values)
         return resp
 
     def get_user_id(self, email):
-        query = f"select user_id from openai_chat.users where user_name = '{email}'; "
-        resp = self.execute_query(query, with_result=True)
+        resp = self.execute_statement("get_user_id", values={"email": email}, with_result=True)
         return str(resp[0]['user_id'])
+
+    def resolve_user_id(self, email):
+        values = {"user_id": uuid.uuid4(), "email": email}
+        resp = self.execute_statement("resolve_user_id", values=values, with_result=True)
+        if not resp:
+            # a concurrent first request inserted the user after this statement's snapshot was taken
+            resp = self.execute_statement("resolve_user_id", values=values, with_result=True)
+        return str(resp[0]['user_id'])
+
+    def delete_user(self, email):
+        resp = self.execute_statement("delete_user", values={"email": email}, with_result=True)
+        return len(resp) > 0
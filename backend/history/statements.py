@@ -0,0 +1,142 @@
+import re
+
+from sqlalchemy import text
+
+# ":name" bind parameters, but not "::type" casts
+PARAMETER_PATTERN = re.compile(r"(?<!:):(\w+)")
+
+
+class Statement:
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        self.parameters = list(dict.fromkeys(PARAMETER_PATTERN.findall(sql)))
+        self.text = text(sql)
+        positions = {parameter: index for index, parameter in enumerate(self.parameters, start=1)}
+        self.prepare_text = text(f"PREPARE {name} AS " +
+                                 PARAMETER_PATTERN.sub(lambda match: f"${positions[match.group(1)]}", sql))
+        arguments = ", ".join(f":{parameter}" for parameter in self.parameters)
+        self.execute_text = text(f"EXECUTE {name}({arguments})" if arguments else f"EXECUTE {name}")
+
+
+class StatementRegistry:
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.statements = {}
+
+    def add(self, name, sql):
+        if name in self.statements:
+            raise ValueError(f"Statement {name} is already registered")
+        self.statements[name] = Statement(f"{self.prefix}{name}", sql)
+
+    def __getitem__(self, name):
+        return self.statements[name]
+
+    def __iter__(self):
+        return iter(self.statements)
+
+
+statements = StatementRegistry("openai_chat_")
+
+statements.add("get_conversations_asc",
+               "select * from openai_chat.conversations where user_id = :user_id order by updated_at ASC;")
+statements.add("get_conversations_desc",
+               "select * from openai_chat.conversations where user_id = :user_id order by updated_at DESC;")
+statements.add("get_conversation",
+               "select * from openai_chat.conversations where conversation_id = :cov_id;")
+statements.add("rename_conversation",
+               "update openai_chat.conversations set updated_at = now(),title = :title "
+               "where conversation_id = :cov_id;")
+statements.add("touch_conversation",
+               "update openai_chat.conversations set updated_at = now() where conversation_id = :cov_id;")
+statements.add("create_conversation",
+               "insert into openai_chat.conversations(conversation_id,user_id,title) values (:cov_id,:user_id,:title);")
+# messages are deleted in the same statement so this also works on schemas created before ON DELETE CASCADE,
+# and summaries have no foreign key to cascade from
+statements.add("delete_conversation",
+               "with deleted_messages as (delete from openai_chat.messages where conversation_id = :cov_id), "
+               "deleted_summaries as (delete from openai_chat.conversation_summaries where conversation_id = :cov_id) "
+               "delete from openai_chat.conversations where conversation_id = :cov_id;")
+statements.add("delete_user_conversations",
+               "with user_conversations as (select conversation_id from openai_chat.conversations "
+               "where user_id = :user_id), "
+               "deleted_messages as (delete from openai_chat.messages "
+               "where conversation_id in (select conversation_id from user_conversations)), "
+               "deleted_summaries as (delete from openai_chat.conversation_summaries "
+               "where conversation_id in (select conversation_id from user_conversations)) "
+               "delete from openai_chat.conversations where user_id = :user_id returning conversation_id;")
+# the parent conversation's updated_at is touched in the same statement as the insert
+statements.add("create_message",
+               "with inserted as (insert into openai_chat.messages(message_id,conversation_id,role,content,"
+               "is_file_data) values (:msg_id,:cov_id,:role,:content,:is_file_data) "
+               "ON CONFLICT (message_id) DO NOTHING returning message_id) "
+               "update openai_chat.conversations set updated_at = now() where conversation_id = :cov_id;")
+statements.add("create_message_with_mask",
+               "with inserted as (insert into openai_chat.messages(message_id,conversation_id,role,content,"
+               "masked_content) values (:msg_id,:cov_id,:role,:content,:masked_content) returning message_id) "
+               "update openai_chat.conversations set updated_at = now() where conversation_id = :cov_id;")
+# a whole turn in one round trip: the conversation is created or touched and every message is inserted.
+# messages arrive as a json array so the statement text does not depend on how many there are, and the
+# position offsets created_at by a microsecond per message to keep the turn in order.
+# another user's conversation is neither touched nor written to, and then no row at all comes back.
+statements.add("create_turn",
+               "with conversation as (insert into openai_chat.conversations(conversation_id,user_id,title) "
+               "values (CAST(:cov_id AS uuid),CAST(:user_id AS uuid),:title) "
+               "ON CONFLICT (conversation_id) DO UPDATE SET updated_at = now() "
+               "WHERE openai_chat.conversations.user_id = CAST(:user_id AS uuid) returning updated_at), "
+               "turn as (select * from json_to_recordset(CAST(:messages AS json)) as t(message_id uuid, "
+               "role varchar, content text, masked_content text, pii_identified text, tokens_identified text, "
+               "is_file_data boolean, position integer)), "
+               "inserted as (insert into openai_chat.messages(message_id,conversation_id,role,content,"
+               "masked_content,pii_identified,tokens_identified,is_file_data,created_at) "
+               "select message_id,CAST(:cov_id AS uuid),role,content,masked_content,pii_identified,"
+               "tokens_identified,is_file_data,now() + position * interval '1 microsecond' "
+               "from turn cross join conversation "
+               "ON CONFLICT (message_id) DO NOTHING returning message_id, created_at) "
+               "select inserted.message_id, inserted.created_at, conversation.updated_at as conversation_updated_at "
+               "from conversation left join inserted on true order by inserted.created_at;")
+statements.add("get_messages",
+               "select * from openai_chat.messages where conversation_id = :cov_id order by created_at ASC;")
+statements.add("delete_messages",
+               "delete from openai_chat.messages where conversation_id = :cov_id returning message_id;")
+statements.add("update_message",
+               "update openai_chat.messages set masked_content = :content, pii_identified = :pii_identified, "
+               "tokens_identified = :tokens_identified where message_id = :msg_id;")
+statements.add("get_identified_tokens",
+               "select pii_identified, tokens_identified from openai_chat.messages "
+               "where conversation_id = (select conversation_id from openai_chat.conversations "
+               "where conversation_id = :cov_id and user_id = :user_id) "
+               "and tokens_identified is not null order by created_at ASC;")
+statements.add("get_conversation_summary",
+               "select summary, compacted_count, history_digest from openai_chat.conversation_summaries "
+               "where conversation_id = :cov_id;")
+statements.add("upsert_conversation_summary",
+               "insert into openai_chat.conversation_summaries(conversation_id,summary,compacted_count,"
+               "history_digest) values (:cov_id,:summary,:compacted_count,:history_digest) "
+               "ON CONFLICT (conversation_id) DO UPDATE SET summary = excluded.summary, "
+               "compacted_count = excluded.compacted_count, history_digest = excluded.history_digest, "
+               "updated_at = now();")
+statements.add("create_user",
+               "INSERT INTO openai_chat.users (user_id, user_name) VALUES (:user_id, :email) "
+               "ON CONFLICT (user_name) DO NOTHING;")
+statements.add("get_user_id",
+               "select user_id from openai_chat.users where user_name = :email;")
+# inserts the user on first sight and returns the id either way, in one round trip
+statements.add("resolve_user_id",
+               "with inserted as (INSERT INTO openai_chat.users (user_id, user_name) VALUES (:user_id, :email) "
+               "ON CONFLICT (user_name) DO NOTHING returning user_id) "
+               "select user_id from inserted union all "
+               "select user_id from openai_chat.users where user_name = :email limit 1;")
+# foreign keys are checked at the end of the statement, so the user's history can go in the same statement
+statements.add("delete_user",
+               "with user_conversations as (select conversation_id from openai_chat.conversations "
+               "where user_id = (select user_id from openai_chat.users where user_name = :email)), "
+               "deleted_messages as (delete from openai_chat.messages "
+               "where conversation_id in (select conversation_id from user_conversations)), "
+               "deleted_summaries as (delete from openai_chat.conversation_summaries "
+               "where conversation_id in (select conversation_id from user_conversations)), "
+               "deleted_conversations as (delete from openai_chat.conversations "
+               "where conversation_id in (select conversation_id from user_conversations)) "
+               "delete from openai_chat.users where user_name = :email returning user_id;")
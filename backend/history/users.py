@@ -0,0 +1,62 @@
+import hashlib
+import logging
+
+from backend.cache.lrucache import TTLCache
+
+logger = logging.getLogger("my_logger")
+
+
+class UserDirectory:
+
+    def __init__(self, database, max_entries=10000, ttl=300, redis_client=None, key_prefix="gptguard:user-version:"):
+        self.database = database
+        # per worker; without redis the ttl bounds how long another worker's deletion can go unnoticed here
+        self.ttl = int(ttl)
+        self.user_ids = TTLCache(max_entries=max_entries, ttl=self.ttl)
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+
+    def version_key(self, email):
+        return self.key_prefix + hashlib.sha256(email.encode("utf-8")).hexdigest()
+
+    def version(self, email):
+        # bumped by whichever worker deletes the user, so every worker re-resolves the id on its next request
+        if self.redis_client is None:
+            return None
+        try:
+            return self.redis_client.get(self.version_key(email))
+        except Exception as e:
+            logger.warning(f"User cache version unavailable - {str(e)}")
+            return False
+
+    def get_user_id(self, email):
+        version = self.version(email)
+        entry = self.user_ids.get(email)
+        # with redis unreachable (False) the cached id is trusted until its ttl, as it is without redis
+        if entry is None or (version is not False and entry[0] != version):
+            entry = (version, self.database.resolve_user_id(email))
+            self.user_ids.set(email, entry)
+        return entry[1]
+
+    def delete_user(self, email):
+        self.user_ids.delete(email)
+        try:
+            return self.database.delete_user(email)
+        finally:
+            # a request that raced the delete may have cached the old id again
+            self.user_ids.delete(email)
+            if self.redis_client is not None:
+                try:
+                    # entries cached before the bump expire within the ttl, and so can the key
+                    pipeline = self.redis_client.pipeline()
+                    pipeline.incr(self.version_key(email))
+                    pipeline.expire(self.version_key(email), self.ttl)
+                    pipeline.execute()
+                except Exception as e:
+                    logger.warning(f"Unable to invalidate other workers' cached user id - {str(e)}")
+
+    def invalidate(self, email):
+        self.user_ids.delete(email)
+
+    def stats(self):
+        return self.user_ids.stats()
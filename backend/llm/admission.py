@@ -0,0 +1,200 @@
+import logging
+import math
+import threading
+import time
+import uuid
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger("my_logger")
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LocalRateLimiter:
+
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        self.__lock = threading.Lock()
+        self.token_capacity = float(tokens_per_minute)
+        self.request_capacity = float(requests_per_minute)
+        self.tokens = self.token_capacity
+        self.requests = self.request_capacity
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+
+    def try_acquire(self, tokens):
+        # takes from both buckets or from neither; returns 0 or the seconds until both could be satisfied
+        tokens = min(float(tokens), self.token_capacity)
+        with self.__lock:
+            now = time.monotonic()
+            elapsed = now - self.updated_at
+            self.updated_at = now
+            self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_capacity / 60)
+            self.requests = min(self.request_capacity, self.requests + elapsed * self.request_capacity / 60)
+            if self.tokens >= tokens and self.requests >= 1:
+                self.tokens -= tokens
+                self.requests -= 1
+                return 0
+            return max((tokens - self.tokens) * 60 / self.token_capacity,
+                       (1 - self.requests) * 60 / self.request_capacity)
+
+    def enter_queue(self, max_queue):
+        with self.__lock:
+            if self.waiting >= max_queue:
+                return None
+            self.waiting += 1
+            return True
+
+    def leave_queue(self, ticket):
+        with self.__lock:
+            self.waiting -= 1
+
+    def queue_depth(self):
+        return self.waiting
+
+
+# KEYS: bucket hash, ARGV: now, token capacity, request capacity, tokens wanted
+REDIS_ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local token_capacity = tonumber(ARGV[2])
+local request_capacity = tonumber(ARGV[3])
+local wanted = math.min(tonumber(ARGV[4]), token_capacity)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'requests', 'updated_at')
+local tokens = tonumber(state[1]) or token_capacity
+local requests = tonumber(state[2]) or request_capacity
+local elapsed = math.max(0, now - (tonumber(state[3]) or now))
+tokens = math.min(token_capacity, tokens + elapsed * token_capacity / 60)
+requests = math.min(request_capacity, requests + elapsed * request_capacity / 60)
+local wait = 0
+if tokens >= wanted and requests >= 1 then
+    tokens = tokens - wanted
+    requests = requests - 1
+else
+    wait = math.max((wanted - tokens) * 60 / token_capacity, (1 - requests) * 60 / request_capacity)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'requests', tostring(requests), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], 120)
+return tostring(wait)
+"""
+
+# KEYS: queue sorted set, ARGV: now, stale before, max queue, ticket
+# every waiter is scored with its arrival time, so one that never left is dropped once it is stale
+REDIS_ENTER_QUEUE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], 300)
+return 1
+"""
+
+
+class RedisRateLimiter:
+    # the same buckets kept in redis so all workers draw from one quota
+
+    def __init__(self, redis_client, tokens_per_minute, requests_per_minute, stale_after=60,
+                 key_prefix="gptguard:admission:"):
+        self.redis_client = redis_client
+        self.token_capacity = float(tokens_per_minute)
+        self.request_capacity = float(requests_per_minute)
+        # longer than any admission wait, so only waiters of crashed workers are this old
+        self.stale_after = float(stale_after)
+        self.bucket_key = key_prefix + "bucket"
+        self.queue_key = key_prefix + "waiters"
+        self.script = redis_client.register_script(REDIS_ACQUIRE_SCRIPT)
+        self.enter_queue_script = redis_client.register_script(REDIS_ENTER_QUEUE_SCRIPT)
+        # while redis is unreachable this worker keeps admitting against buckets of its own
+        self.fallback = LocalRateLimiter(tokens_per_minute, requests_per_minute)
+
+    def try_acquire(self, tokens):
+        try:
+            return float(self.script(keys=[self.bucket_key],
+                                     args=[time.time(), self.token_capacity, self.request_capacity, float(tokens)]))
+        except RedisError as e:
+            logger.warning(f"Shared rate limit unavailable, using this worker's buckets - {str(e)}")
+            return self.fallback.try_acquire(tokens)
+
+    def enter_queue(self, max_queue):
+        ticket = uuid.uuid4().hex
+        now = time.time()
+        try:
+            if not int(self.enter_queue_script(keys=[self.queue_key],
+                                               args=[now, now - self.stale_after, int(max_queue), ticket])):
+                return None
+        except RedisError as e:
+            logger.warning(f"Shared admission queue unavailable, using this worker's queue - {str(e)}")
+            return self.fallback.enter_queue(max_queue)
+        return ticket
+
+    def leave_queue(self, ticket):
+        if ticket is True:
+            self.fallback.leave_queue(ticket)
+            return
+        try:
+            self.redis_client.zrem(self.queue_key, ticket)
+        except RedisError as e:
+            # the ticket goes stale and is pruned by a later enter_queue
+            logger.warning(f"Unable to leave shared admission queue - {str(e)}")
+
+    def queue_depth(self):
+        try:
+            return int(self.redis_client.zcount(self.queue_key, time.time() - self.stale_after, "+inf"))
+        except RedisError:
+            return self.fallback.queue_depth()
+
+
+class AdmissionController:
+
+    def __init__(self, limiter, max_queue=8, max_wait=10, metrics=None):
+        self.limiter = limiter
+        self.max_queue = int(max_queue)
+        self.max_wait = float(max_wait)
+        self.metrics = metrics
+
+    def count(self, name, value=1):
+        if self.metrics:
+            self.metrics.increment(f"admission.{name}", value)
+
+    def reject(self, reason, retry_after):
+        self.count(f"rejected.{reason}")
+        retry_after = max(1, math.ceil(retry_after))
+        raise AdmissionRejected(f"OpenAI quota exhausted ({reason}), retry in {retry_after}s", retry_after)
+
+    def admit(self, tokens, deadline=None):
+        # the queue only bounds how many requests wait, it does not order them: every waiter polls the
+        # buckets and whichever polls first after a refill is admitted, wherever it stands in the queue
+        wait = self.limiter.try_acquire(tokens)
+        if wait == 0:
+            self.count("admitted")
+            return 0
+        max_wait = self.max_wait if deadline is None else min(self.max_wait, deadline.remaining())
+        if wait > max_wait:
+            self.reject("wait", wait)
+        ticket = self.limiter.enter_queue(self.max_queue)
+        if ticket is None:
+            self.reject("queue_full", wait)
+
+        started_at = time.monotonic()
+        try:
+            while wait > 0:
+                waited = time.monotonic() - started_at
+                if waited + wait > max_wait:
+                    self.reject("wait", wait)
+                time.sleep(min(wait, 0.25))
+                wait = self.limiter.try_acquire(tokens)
+        finally:
+            self.limiter.leave_queue(ticket)
+        waited = time.monotonic() - started_at
+        self.count("queued")
+        if self.metrics:
+            self.metrics.observe("admission.wait_seconds", waited)
+        return waited
+
+    def stats(self):
+        return {"queue_depth": self.limiter.queue_depth()}
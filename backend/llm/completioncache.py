@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import time
+
+from openai.util import convert_to_openai_object
+
+from backend.cache.lrucache import TTLCache
+
+logger = logging.getLogger("my_logger")
+
+CACHE_KEY_PARAMS = ("model", "temperature", "top_p", "max_tokens", "stop", "messages")
+
+
+def completion_size(completion):
+    return sum(len(choice["message"]["content"] or "") for choice in completion["choices"])
+
+
+class CompletionCache:
+
+    def __init__(self, max_entries=1000, ttl=3600, max_bytes=64 * 1024 * 1024, redis_client=None,
+                 key_prefix="gptguard:completion:"):
+        self.ttl = int(ttl)
+        self.local = TTLCache(max_entries=max_entries, ttl=self.ttl, max_bytes=max_bytes, sizeof=completion_size)
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+    @staticmethod
+    def is_cacheable(params):
+        # sampled completions are not reproducible, only greedy decoding may be served from the cache
+        return float(params.get("temperature") or 0) == 0
+
+    @staticmethod
+    def key(tenant, params):
+        material = json.dumps([tenant] + [params.get(name) for name in CACHE_KEY_PARAMS],
+                              sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        completion = self.local.get(key)
+        if completion is None and self.redis_client is not None:
+            try:
+                raw = self.redis_client.get(self.key_prefix + key)
+            except Exception as e:
+                self.shared_errors += 1
+                logger.warning(f"Completion cache shared backend read failed - {str(e)}")
+                raw = None
+            if raw is not None:
+                completion = json.loads(raw)
+                self.shared_hits += 1
+                self.local.set(key, completion)
+        return completion
+
+    def set(self, key, completion):
+        self.local.set(key, completion)
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self.key_prefix + key, json.dumps(completion), ex=self.ttl)
+        except Exception as e:
+            self.shared_errors += 1
+            logger.warning(f"Completion cache shared backend write failed - {str(e)}")
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["shared_hits"] = self.shared_hits
+        stats["shared_errors"] = self.shared_errors
+        return stats
+
+
+def replay_completion(completion, stream):
+    if not stream:
+        return convert_to_openai_object(completion)
+    chunk = {
+        "id": completion["id"],
+        "model": completion["model"],
+        "created": completion["created"],
+        "object": "chat.completion.chunk",
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": completion["choices"][0]["message"]["content"]},
+                     "finish_reason": completion["choices"][0].get("finish_reason")}]
+    }
+    return iter([convert_to_openai_object(chunk)])
+
+
+def record_stream(response, on_complete):
+    # passes the chunks through and hands the assembled completion over once the stream finished cleanly
+    content = ""
+    finish_reason = None
+    line = None
+    for line in response:
+        if line["choices"]:
+            content += line["choices"][0]["delta"].get("content") or ""
+            finish_reason = line["choices"][0].get("finish_reason") or finish_reason
+        yield line
+    if line is not None and finish_reason == "stop":
+        on_complete({
+            "id": line["id"],
+            "model": line["model"],
+            "created": line.get("created", int(time.time())),
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": finish_reason}]
+        })
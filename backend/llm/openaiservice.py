@@ -0,0 +1,121 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("my_logger")
+
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout,
+                    openai.error.APIConnectionError, openai.error.TryAgain)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+
+    def __init__(self, seconds):
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + float(seconds)
+
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def remaining(self, reserve=0):
+        return self.expires_at - time.monotonic() - float(reserve)
+
+    def check(self, stage, reserve=0):
+        if self.remaining(reserve) <= 0:
+            raise DeadlineExceeded(f"Request deadline exceeded before {stage} ({self.elapsed():.1f}s spent)")
+
+
+class PooledSession(requests.Session):
+    # openai closes its thread's session every MAX_SESSION_LIFETIME_SECS, which would tear down the pool that
+    # every thread of the worker shares; only shutdown() really closes it
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class OpenAIClient:
+    __session_lock = threading.Lock()
+
+    def __init__(self, api_key, connect_timeout=3.05, read_timeout=60, max_retries=2, backoff_factor=0.5,
+                 backoff_max=8, pool_maxsize=10):
+        self.api_key = api_key
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.backoff_max = float(backoff_max)
+        self.pool_maxsize = int(pool_maxsize)
+        self._session = None
+        self._session_pid = None
+        # process-wide: openai builds a session per thread; hand every one of them this worker's pooled session
+        openai.requestssession = self.get_session
+
+    def get_session(self):
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with OpenAIClient.__session_lock:
+                if self._session is None or self._session_pid != pid:
+                    session = PooledSession()
+                    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize,
+                                                          max_retries=0))
+                    self._session = session
+                    self._session_pid = pid
+        return self._session
+
+    @staticmethod
+    def retry_after(error):
+        headers = getattr(error, "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def backoff(self, attempt, error):
+        # a server hint is never shortened, retrying before it only earns another 429
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    def is_retryable(self, error):
+        if isinstance(error, RETRYABLE_ERRORS):
+            return True
+        return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+    def create_chat_completion(self, params, deadline=None, reserve=0):
+        attempt = 0
+        while True:
+            read_timeout = self.read_timeout
+            if deadline is not None:
+                deadline.check("openai_api call", reserve)
+                read_timeout = min(read_timeout, deadline.remaining(reserve))
+            try:
+                return openai.ChatCompletion.create(api_key=self.api_key,
+                                                    request_timeout=(self.connect_timeout, read_timeout),
+                                                    **params)
+            except Exception as e:
+                if not self.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                if deadline is not None and delay >= deadline.remaining(reserve):
+                    # the caller answers with the error's own Retry-After instead of waiting it out here
+                    raise
+                logger.warning(f"openai_api call failed ({type(e).__name__}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                attempt += 1
@@ -0,0 +1,61 @@
+import json
+
+
+class ModelRoute:
+
+    def __init__(self, model, context_window, cost=1.0, latency=1.0):
+        self.model = model
+        self.context_window = int(context_window)
+        self.cost = float(cost)
+        self.latency = float(latency)
+
+    def fits(self, prompt_tokens, completion_tokens):
+        return prompt_tokens + completion_tokens <= self.context_window
+
+
+class RoutingDecision:
+
+    def __init__(self, route, prompt_tokens, fits):
+        self.route = route
+        self.prompt_tokens = prompt_tokens
+        self.fits = fits
+
+    def __str__(self):
+        return (f"model={self.route.model} context_window={self.route.context_window} "
+                f"prompt_tokens={self.prompt_tokens} fits={self.fits}")
+
+
+class ModelRouter:
+
+    def __init__(self, routes, default=None, prefer_default=False):
+        if not routes and default is None:
+            raise ValueError("Model routing table is empty")
+        # the default competes on its cost like any other route, unless it is preferred (e.g. a fine-tuned
+        # model), and then it serves every prompt it can hold and the table only takes the rest
+        self.default = default
+        self.prefer_default = prefer_default
+        if default is not None and default not in routes:
+            routes = routes + [default]
+        # cheapest first, then fastest, then the smallest window
+        self.routes = sorted(routes, key=lambda route: (route.cost, route.latency, route.context_window))
+        self.largest = max(routes, key=lambda route: route.context_window)
+
+    @classmethod
+    def from_json(cls, routes_json, default_model=None, default_context_window=None, prefer_default=False):
+        routes = [ModelRoute(route["model"], route["context_window"], route.get("cost", 1.0),
+                             route.get("latency", 1.0)) for route in json.loads(routes_json)]
+        default = None
+        if default_model:
+            default = next((route for route in routes if route.model == default_model), None)
+            if default is None:
+                default = ModelRoute(default_model, default_context_window)
+        return cls(routes, default, prefer_default)
+
+    def choose(self, prompt_tokens, completion_tokens):
+        if self.prefer_default and self.default is not None and self.default.fits(prompt_tokens, completion_tokens):
+            return RoutingDecision(self.default, prompt_tokens, True)
+        for route in self.routes:
+            if route.fits(prompt_tokens, completion_tokens):
+                return RoutingDecision(route, prompt_tokens, True)
+        # nothing fits: the caller trims history to the largest window
+        return RoutingDecision(self.largest, prompt_tokens, False)
@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger("my_logger")
+
+
+class SharedStream:
+    # lets several requests read one upstream stream; whichever reader is ahead pulls the next chunk
+
+    def __init__(self, upstream, on_close=None):
+        self.__lock = threading.Lock()
+        self.__cond = threading.Condition(self.__lock)
+        self.upstream = iter(upstream)
+        self.on_close = on_close
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+
+    def reader(self):
+        index = 0
+        while True:
+            with self.__cond:
+                while index >= len(self.chunks) and not self.done and self.pulling:
+                    self.__cond.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    index += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    self.pulling = True
+                    chunk = None
+            if chunk is not None:
+                yield chunk
+                continue
+            try:
+                chunk = next(self.upstream)
+                finished = False
+            except StopIteration:
+                finished = True
+            except Exception as e:
+                self.error = e
+                finished = True
+            with self.__cond:
+                self.pulling = False
+                if finished:
+                    self.done = True
+                else:
+                    self.chunks.append(chunk)
+                self.__cond.notify_all()
+            if finished and self.on_close:
+                self.on_close()
+
+
+class Flight:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.started_at = time.monotonic()
+
+
+class SingleFlight:
+
+    def __init__(self, backend=None, max_age=120, metrics=None):
+        self.__lock = threading.Lock()
+        self.flights = {}
+        self.backend = backend
+        self.max_age = float(max_age)
+        self.metrics = metrics
+
+    def count(self, name):
+        if self.metrics:
+            self.metrics.increment(f"single_flight.{name}")
+
+    def do(self, key, fn, stream=False, deadline=None):
+        with self.__lock:
+            flight = self.flights.get(key)
+            if flight is not None and time.monotonic() - flight.started_at > self.max_age:
+                flight = None
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if not leader:
+            self.count("follower")
+            timeout = self.max_age if deadline is None else max(deadline.remaining(), 0)
+            if not flight.event.wait(timeout):
+                # the leader is still waiting on upstream; this request makes its own call rather than time out
+                self.count("follower_timeout")
+                return fn()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result.reader() if stream else flight.result
+
+        self.count("leader")
+        try:
+            if stream:
+                # the flight stays open until the stream is drained so late arrivals replay it from the start
+                flight.result = SharedStream(fn(), on_close=lambda: self.finish(key, flight))
+            elif self.backend is not None:
+                flight.result = self.backend.run(key, fn)
+            else:
+                flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            self.finish(key, flight)
+            raise
+        finally:
+            flight.event.set()
+        if stream:
+            return flight.result.reader()
+        self.finish(key, flight)
+        return flight.result
+
+    def finish(self, key, flight):
+        with self.__lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+
+class RedisFlightBackend:
+    # coalesces non-streamed calls across worker processes through a redis lock
+
+    def __init__(self, redis_client, dumps, loads, lock_ttl=60, result_ttl=30, wait_timeout=60, poll_interval=0.05,
+                 key_prefix="gptguard:flight:"):
+        self.redis_client = redis_client
+        self.dumps = dumps
+        self.loads = loads
+        self.lock_ttl_ms = int(float(lock_ttl) * 1000)
+        self.result_ttl = int(result_ttl)
+        self.wait_timeout = float(wait_timeout)
+        self.poll_interval = float(poll_interval)
+        self.key_prefix = key_prefix
+
+    def run(self, key, fn):
+        try:
+            return self._run(key, fn)
+        except RedisUnavailable:
+            return fn()
+
+    def _run(self, key, fn):
+        lock_key = self.key_prefix + "lock:" + key
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            flight_id = uuid.uuid4().hex
+            if self.call(self.redis_client.set, lock_key, flight_id, nx=True, px=self.lock_ttl_ms):
+                try:
+                    result = fn()
+                    self.publish(flight_id, result)
+                    return result
+                finally:
+                    self.release(lock_key, flight_id)
+            leader_id = self.call(self.redis_client.get, lock_key)
+            if leader_id is None:
+                continue
+            raw = self.wait(lock_key, leader_id, deadline)
+            if raw is not None:
+                return self.loads(raw)
+        logger.warning("Timed out waiting for another worker's identical request, calling upstream directly")
+        return fn()
+
+    def wait(self, lock_key, leader_id, deadline):
+        result_key = self.key_prefix + "result:" + (leader_id.decode() if isinstance(leader_id, bytes) else leader_id)
+        while time.monotonic() < deadline:
+            raw = self.call(self.redis_client.get, result_key)
+            if raw is not None:
+                return raw
+            if self.call(self.redis_client.get, lock_key) != leader_id:
+                # the leader gave up without a result, try to lead the next attempt
+                return None
+            time.sleep(self.poll_interval)
+        return None
+
+    def publish(self, flight_id, result):
+        try:
+            self.redis_client.set(self.key_prefix + "result:" + flight_id, self.dumps(result), ex=self.result_ttl)
+        except Exception as e:
+            logger.warning(f"Unable to share single flight result - {str(e)}")
+
+    def release(self, lock_key, flight_id):
+        try:
+            self.redis_client.eval("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                                   "return redis.call('del', KEYS[1]) end return 0", 1, lock_key, flight_id)
+        except Exception as e:
+            logger.warning(f"Unable to release single flight lock - {str(e)}")
+
+    @staticmethod
+    def call(method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Single flight redis call failed - {str(e)}")
+            raise RedisUnavailable() from e
+
+
+class RedisUnavailable(Exception):
+    pass
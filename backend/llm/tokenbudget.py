@@ -0,0 +1,85 @@
+import hashlib
+import threading
+
+import tiktoken
+
+from backend.cache.lrucache import TTLCache
+
+# chat format overhead, see https://github.com/openai/openai-cookbook "How to count tokens with tiktoken"
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+DEFAULT_ENCODING = "cl100k_base"
+
+_lock = threading.Lock()
+_encodings = {}
+
+
+def get_encoding(model):
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _lock:
+            encoding = _encodings.get(model)
+            if encoding is None:
+                encoding = load_encoding(model)
+                _encodings[model] = encoding
+    return encoding
+
+
+def load_encoding(model):
+    if not model:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+    # fine-tuned models look like "ft:gpt-3.5-turbo-1106:org::id" and share their base model's encoding
+    base_model = model.split(":")[1] if model.startswith("ft:") else model
+    try:
+        return tiktoken.encoding_for_model(base_model)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text, encoding):
+    return len(encoding.encode(text, disallowed_special=())) if text else 0
+
+
+class CachedTokenCounter:
+
+    def __init__(self, max_entries=20000):
+        self.cache = TTLCache(max_entries=max_entries)
+
+    def __call__(self, text, encoding):
+        if not text:
+            return 0
+        # history is resent every turn, so earlier messages hit here instead of being re-encoded
+        key = (encoding.name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest())
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = count_tokens(text, encoding)
+            self.cache.set(key, tokens)
+        return tokens
+
+    def stats(self):
+        return self.cache.stats()
+
+
+def count_message_tokens(message, encoding, count=count_tokens):
+    tokens = TOKENS_PER_MESSAGE + count(message["role"], encoding) + count(message["content"], encoding)
+    if message.get("name"):
+        tokens += TOKENS_PER_NAME + count(message["name"], encoding)
+    return tokens
+
+
+def count_prompt_tokens(messages, encoding, count=count_tokens):
+    return TOKENS_PER_REPLY + sum(count_message_tokens(message, encoding, count) for message in messages)
+
+
+def trim_to_budget(messages, budget, encoding, count=count_tokens):
+    # walks the history once from the newest message and keeps the longest suffix that fits
+    total = TOKENS_PER_REPLY
+    start = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        tokens = count_message_tokens(messages[index], encoding, count)
+        if total + tokens > int(budget):
+            break
+        total += tokens
+        start = index
+    return messages[start:], total
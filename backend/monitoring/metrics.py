@@ -0,0 +1,46 @@
+import threading
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.sources = {}
+
+    def increment(self, name, value=1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.__lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = {"count": 0, "sum": 0.0, "max": 0.0}
+                self.timings[name] = timing
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["max"] = max(timing["max"], value)
+
+    def register(self, name, source):
+        # source is a callable returning a dict, e.g. a cache's stats method
+        with self.__lock:
+            self.sources[name] = source
+
+    def snapshot(self):
+        with self.__lock:
+            counters = dict(self.counters)
+            timings = {name: dict(timing, avg=timing["sum"] / timing["count"])
+                       for name, timing in self.timings.items()}
+            sources = dict(self.sources)
+        snapshot = {"counters": counters, "timings": timings}
+        for name, source in sources.items():
+            try:
+                snapshot[name] = source()
+            except Exception as e:
+                snapshot[name] = {"error": str(e)}
+        return snapshot
+
+
+metrics = MetricsRegistry()
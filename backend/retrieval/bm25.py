@@ -0,0 +1,77 @@
+import hashlib
+import math
+import re
+from collections import Counter
+
+from backend.cache.lrucache import TTLCache
+from backend.tokenisation.chunking import split_text
+
+TERM_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TERM_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(frequencies.values()) for frequencies in self.term_frequencies]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        document_frequencies = Counter()
+        for frequencies in self.term_frequencies:
+            document_frequencies.update(frequencies.keys())
+        total = len(chunks)
+        self.idf = {term: math.log(1 + (total - count + 0.5) / (count + 0.5))
+                    for term, count in document_frequencies.items()}
+
+    def scores(self, query):
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = []
+        for frequencies, length in zip(self.term_frequencies, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length) if self.average_length else self.k1
+            for term in terms:
+                frequency = frequencies.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query, top_k):
+        # returns chunk positions in document order so the excerpt reads naturally
+        scores = self.scores(query)
+        ranked = sorted((index for index, score in enumerate(scores) if score > 0),
+                        key=lambda index: scores[index], reverse=True)[:int(top_k)]
+        return sorted(ranked)
+
+
+class DocumentRetriever:
+
+    def __init__(self, chunk_chars=1500, top_k=4, min_chars=6000, max_documents=64):
+        self.chunk_chars = int(chunk_chars)
+        self.top_k = int(top_k)
+        self.min_chars = int(min_chars)
+        self.indexes = TTLCache(max_entries=max_documents)
+
+    def get_index(self, document):
+        key = hashlib.sha256(document.encode("utf-8")).hexdigest()
+        index = self.indexes.get(key)
+        if index is None:
+            index = BM25Index(split_text(document, self.chunk_chars))
+            self.indexes.set(key, index)
+        return index
+
+    def excerpt(self, document, query):
+        if len(document) <= self.min_chars:
+            return document
+        index = self.get_index(document)
+        positions = index.search(query or "", self.top_k) or list(range(min(self.top_k, len(index.chunks))))
+        return "\n...\n".join(index.chunks[position].strip() for position in positions)
+
+    def stats(self):
+        return self.indexes.stats()
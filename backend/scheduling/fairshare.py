@@ -0,0 +1,196 @@
+import logging
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger("my_logger")
+
+
+class QueueRejected(Exception):
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+
+    def __init__(self, user):
+        self.user = user
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+# KEYS: the user's slot sorted set, ARGV: now, stale before, max per user, ticket
+# every slot is scored with the time it was taken, so one that a crashed worker never released is dropped once stale
+REDIS_ACQUIRE_SLOT_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], 300)
+return 1
+"""
+
+
+class RedisUserSlots:
+    # caps one user's in-flight requests across all workers
+
+    def __init__(self, redis_client, max_per_user, ttl=120, key_prefix="gptguard:inflight:"):
+        self.redis_client = redis_client
+        self.max_per_user = int(max_per_user)
+        # longer than any request may run, so only slots of crashed workers are this old
+        self.ttl = float(ttl)
+        self.key_prefix = key_prefix
+        self.script = redis_client.register_script(REDIS_ACQUIRE_SLOT_SCRIPT)
+
+    def try_acquire(self, user):
+        """Returns the ticket of the slot taken, or None when the user already holds all of theirs."""
+        ticket = uuid.uuid4().hex
+        now = time.time()
+        if not int(self.script(keys=[self.key_prefix + user], args=[now, now - self.ttl, self.max_per_user, ticket])):
+            return None
+        return ticket
+
+    def release(self, user, ticket):
+        self.redis_client.zrem(self.key_prefix + user, ticket)
+
+
+class FairShareScheduler:
+
+    def __init__(self, max_in_flight=4, max_per_user=2, max_queue=32, max_wait=20, shared_slots=None,
+                 metrics=None):
+        self.__cond = threading.Condition()
+        self.max_in_flight = int(max_in_flight)
+        self.max_per_user = int(max_per_user)
+        self.max_queue = int(max_queue)
+        self.max_wait = float(max_wait)
+        self.shared_slots = shared_slots
+        self.metrics = metrics
+        self.in_flight = {}
+        self.total_in_flight = 0
+        # users with waiting requests, in round-robin order
+        self.queues = OrderedDict()
+        self.waiting = 0
+
+    def count(self, name):
+        if self.metrics:
+            self.metrics.increment(f"scheduler.{name}")
+
+    def reject(self, reason):
+        self.count(f"rejected.{reason}")
+        retry_after = max(1, math.ceil(self.max_wait / 4))
+        raise QueueRejected(f"Too many requests in progress ({reason}), retry in {retry_after}s", retry_after)
+
+    def can_run(self, user):
+        return self.total_in_flight < self.max_in_flight and self.in_flight.get(user, 0) < self.max_per_user
+
+    def start(self, user):
+        self.in_flight[user] = self.in_flight.get(user, 0) + 1
+        self.total_in_flight += 1
+
+    def dispatch(self):
+        # grants free slots one user at a time, moving each served user to the back of the line
+        for user in list(self.queues):
+            if self.total_in_flight >= self.max_in_flight:
+                break
+            if not self.can_run(user):
+                continue
+            queue = self.queues.pop(user)
+            ticket = queue.popleft()
+            if queue:
+                self.queues[user] = queue
+            ticket.granted = True
+            self.waiting -= 1
+            self.start(user)
+        self.__cond.notify_all()
+
+    def acquire(self, user):
+        with self.__cond:
+            if not self.queues and self.can_run(user):
+                self.start(user)
+            else:
+                if self.waiting >= self.max_queue:
+                    self.reject("queue_full")
+                ticket = Ticket(user)
+                self.queues.setdefault(user, deque()).append(ticket)
+                self.waiting += 1
+                self.dispatch()
+                deadline = ticket.enqueued_at + self.max_wait
+                while not ticket.granted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.queues[user].remove(ticket)
+                        if not self.queues[user]:
+                            del self.queues[user]
+                        self.waiting -= 1
+                        self.reject("wait")
+                    self.__cond.wait(remaining)
+
+    def release(self, user):
+        with self.__cond:
+            self.in_flight[user] -= 1
+            if not self.in_flight[user]:
+                del self.in_flight[user]
+            self.total_in_flight -= 1
+            self.dispatch()
+
+    def acquire_shared(self, user):
+        # returns the shared slot's ticket, True when only local limits apply, or None when the user is at the limit
+        if self.shared_slots is None:
+            return True
+        try:
+            return self.shared_slots.try_acquire(user)
+        except RedisError as e:
+            logger.warning(f"Shared in-flight counter unavailable, using local limits only - {str(e)}")
+            return True
+
+    def release_shared(self, user, shared):
+        if shared is True:
+            return
+        try:
+            self.shared_slots.release(user, shared)
+        except RedisError as e:
+            logger.warning(f"Unable to release shared in-flight counter - {str(e)}")
+
+    def enter(self, user):
+        # returns the function that frees the slot, so streamed responses can release it once they close
+        started_at = time.monotonic()
+        shared = self.acquire_shared(user)
+        if shared is None:
+            # the user's requests already hold their share of the other workers, waiting here would park this one too
+            self.reject("user_limit")
+        try:
+            self.acquire(user)
+        except Exception:
+            self.release_shared(user, shared)
+            raise
+        if self.metrics:
+            self.metrics.observe("scheduler.wait_seconds", time.monotonic() - started_at)
+        self.count("admitted")
+        lock = threading.Lock()
+        released = []
+
+        def release():
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            self.release_shared(user, shared)
+            self.release(user)
+
+        return release
+
+    def stats(self):
+        with self.__cond:
+            return {
+                "queue_depth": self.waiting,
+                "queued_users": len(self.queues),
+                "in_flight": self.total_in_flight,
+                "in_flight_users": len(self.in_flight)
+            }
@@ -0,0 +1,76 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PARAGRAPH_BOUNDARY = re.compile(r"\n\s*\n")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+_lock = threading.Lock()
+_executors = {}
+
+
+def split_on(text, pattern):
+    # keeps the separator attached to the preceding piece so "".join(pieces) == text
+    pieces = []
+    start = 0
+    for match in pattern.finditer(text):
+        pieces.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def split_text(text, max_chars):
+    max_chars = int(max_chars)
+    if len(text) <= max_chars:
+        return [text] if text else []
+
+    pieces = []
+    for paragraph in split_on(text, PARAGRAPH_BOUNDARY):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in split_on(paragraph, SENTENCE_BOUNDARY):
+            if len(sentence) <= max_chars:
+                pieces.append(sentence)
+            else:
+                pieces.extend(sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars))
+
+    # greedily pack the pieces back into chunks no larger than max_chars
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def get_executor(max_workers):
+    # one pool per worker process; it also caps the mask requests a worker has in flight
+    key = (os.getpid(), int(max_workers))
+    executor = _executors.get(key)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(key)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=int(max_workers), thread_name_prefix="mask-chunk")
+                _executors[key] = executor
+    return executor
+
+
+def mask_in_chunks(text, mask_call, max_chars, max_workers):
+    chunks = split_text(text, max_chars)
+    if len(chunks) <= 1:
+        return mask_call(text)
+
+    results = list(get_executor(max_workers).map(mask_call, chunks))
+    masked_text = "".join(result[0] for result in results)
+    pii_identified = [value for result in results for value in result[1]]
+    identified_tokens = [token for result in results for token in result[2]]
+    return masked_text, pii_identified, identified_tokens
@@ -0,0 +1,68 @@
+import hashlib
+import hmac
+import json
+import logging
+
+from backend.cache.lrucache import TTLCache
+
+logger = logging.getLogger("my_logger")
+
+
+def mask_result_size(result):
+    masked_text, pii_identified, identified_tokens = result
+    return (len(masked_text) + sum(len(value) for value in pii_identified) +
+            sum(len(token["key"]) for token in identified_tokens))
+
+
+class MaskCache:
+
+    def __init__(self, secret, max_entries=2048, ttl=900, max_bytes=32 * 1024 * 1024, redis_client=None,
+                 key_prefix="gptguard:mask:"):
+        # keys are keyed digests so neither the cache nor redis ever holds the raw text as a key
+        self.secret = (secret or "").encode("utf-8")
+        self.ttl = int(ttl)
+        self.local = TTLCache(max_entries=max_entries, ttl=self.ttl, max_bytes=max_bytes, sizeof=mask_result_size)
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.shared_hits = 0
+        self.shared_errors = 0
+
+    def digest(self, text):
+        return hmac.new(self.secret, text.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def get(self, text):
+        key = self.digest(text)
+        result = self.local.get(key)
+        if result is not None or self.redis_client is None:
+            return result
+        try:
+            raw = self.redis_client.get(self.key_prefix + key)
+        except Exception as e:
+            self.shared_errors += 1
+            logger.warning(f"Mask cache shared backend read failed - {str(e)}")
+            return None
+        if raw is None:
+            return None
+        masked_text, pii_identified, identified_tokens = json.loads(raw)
+        result = (masked_text, pii_identified, identified_tokens)
+        self.shared_hits += 1
+        self.local.set(key, result)
+        return result
+
+    def set(self, text, result):
+        key = self.digest(text)
+        result = tuple(result)
+        self.local.set(key, result)
+        if self.redis_client is None:
+            return
+        try:
+            self.redis_client.set(self.key_prefix + key, json.dumps(result), ex=self.ttl)
+        except Exception as e:
+            self.shared_errors += 1
+            logger.warning(f"Mask cache shared backend write failed - {str(e)}")
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["shared_hits"] = self.shared_hits
+        stats["shared_errors"] = self.shared_errors
+        return stats
@@ -0,0 +1,105 @@
+import re
+
+EMAIL_PATTERN = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+URL_PATTERN = re.compile(r"(?:https?://|www\.)\S+", re.IGNORECASE)
+PHONE_PATTERN = re.compile(r"(?:\+\d{1,3}[\s.-]?)?(?:\(\d{2,4}\)[\s.-]?)?\d{2,4}[\s.-]\d{3,4}[\s.-]?\d{3,4}")
+CARD_PATTERN = re.compile(r"(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)")
+SSN_PATTERN = re.compile(r"(?<!\d)\d{3}[- ]\d{2}[- ]\d{4}(?!\d)")
+IPV4_PATTERN = re.compile(r"(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?![\d.])")
+IPV6_PATTERN = re.compile(r"(?<![:\w])(?:[0-9A-Fa-f]{1,4}:){2,7}[0-9A-Fa-f]{0,4}(?![:\w])")
+DATE_PATTERN = re.compile(r"(?<!\d)\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4}(?!\d)")
+LONG_NUMBER_PATTERN = re.compile(r"\d{5,}")
+WORD_PATTERN = re.compile(r"[^\W\d_][\w'’-]*")
+SENTENCE_END = re.compile(r"[.!?:;\n]\s*$")
+
+# capitalised words that are safe at any position in a sentence
+SAFE_CAPITALISED = {
+    "i", "i'm", "i've", "i'd", "i'll", "ok", "okay", "ai", "pdf", "faq", "gpt", "chatgpt", "openai",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+}
+
+# everyday words that commonly start a short prompt; anything else capitalised is treated as a possible name
+COMMON_WORDS = {
+    "a", "about", "above", "according", "add", "after", "again", "all", "also", "an", "and", "answer", "any",
+    "anything", "are", "as", "ask", "at", "be", "because", "before", "below", "best", "better", "brief",
+    "briefly", "but", "by", "can", "change", "check", "clarify", "compare", "continue", "convert", "correct",
+    "could", "create", "define", "describe", "detail", "details", "did", "do", "does", "draft", "each",
+    "elaborate", "even", "every", "example", "explain", "expand", "extract", "find", "first", "fix", "for",
+    "format", "from", "generate", "get", "give", "go", "good", "great", "hello", "help", "here", "hey", "hi",
+    "how", "if", "in", "include", "is", "it", "just", "keep", "last", "let", "let's", "like", "list", "make",
+    "may", "maybe", "me", "more", "most", "my", "next", "nice", "no", "nope", "not", "now", "of", "on", "one",
+    "only", "or", "other", "our", "outline", "please", "point", "points", "provide", "question", "rephrase",
+    "reply", "respond", "rewrite", "same", "say", "see", "shorten", "should", "show", "simplify", "so",
+    "some", "sorry", "sounds", "start", "still", "stop", "summarise", "summarize", "summary", "sure", "tell",
+    "thank", "thanks", "that", "the", "then", "there", "these", "they", "this", "those", "to", "translate",
+    "try", "two", "use", "very", "was", "we", "well", "what", "when", "where", "which", "who", "why", "will",
+    "with", "would", "write", "yes", "yeah", "yep", "you", "your",
+}
+
+
+def luhn_valid(digits):
+    total = 0
+    for index, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if index % 2 == 1:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+
+def detect_card(text):
+    for match in CARD_PATTERN.finditer(text):
+        digits = re.sub(r"\D", "", match.group(0))
+        if 13 <= len(digits) <= 19 and luhn_valid(digits):
+            return True
+    return False
+
+
+def detect_ipv4(text):
+    for match in IPV4_PATTERN.finditer(text):
+        if all(int(octet) <= 255 for octet in match.group(0).split(".")):
+            return True
+    return False
+
+
+def detect_name(text, common_words=COMMON_WORDS):
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group(0)
+        if not word[0].isupper() or word.lower() in SAFE_CAPITALISED:
+            continue
+        sentence_start = match.start() == 0 or SENTENCE_END.search(text, 0, match.start()) is not None
+        if not sentence_start or word.lower() not in common_words:
+            return True
+    return False
+
+
+DETECTORS = (
+    ("email", EMAIL_PATTERN.search),
+    ("url", URL_PATTERN.search),
+    ("ssn", SSN_PATTERN.search),
+    ("card", detect_card),
+    ("phone", PHONE_PATTERN.search),
+    ("ipv4", detect_ipv4),
+    ("ipv6", IPV6_PATTERN.search),
+    ("date", DATE_PATTERN.search),
+    ("number", LONG_NUMBER_PATTERN.search),
+)
+
+
+class PiiPrescreen:
+
+    def __init__(self, max_length=200, extra_common_words=None):
+        self.max_length = int(max_length)
+        self.common_words = COMMON_WORDS | {word.lower() for word in (extra_common_words or [])}
+        self.detectors = DETECTORS + (("name", lambda text: detect_name(text, self.common_words)),)
+
+    def screen(self, text):
+        # returns the reason the text must go to the mask api, or None when it is safe to skip
+        if len(text) > self.max_length:
+            return "length"
+        for name, detector in self.detectors:
+            if detector(text):
+                return name
+        return None
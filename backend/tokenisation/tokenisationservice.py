@@ -0,0 +1,92 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenisationClient:
+    __session_lock = threading.Lock()
+
+    def __init__(self, mask_url, unmask_url, auth_token, connect_timeout=3.05, read_timeout=30,
+                 max_retries=2, backoff_factor=0.25, backoff_max=4, pool_connections=2, pool_maxsize=10,
+                 total_timeout=20):
+        self.mask_url = mask_url
+        self.unmask_url = unmask_url
+        self.auth_token = auth_token
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.backoff_max = float(backoff_max)
+        # all attempts and pauses of one call share this budget, which has to leave room for the OpenAI call
+        # inside the uwsgi worker timeout
+        self.total_timeout = float(total_timeout)
+        self.pool_connections = int(pool_connections)
+        self.pool_maxsize = int(pool_maxsize)
+        self._session = None
+        self._session_pid = None
+
+    def get_session(self):
+        # uwsgi forks workers after the app is imported, so every worker builds its own pool
+        # instead of sharing sockets inherited from the parent process
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with TokenisationClient.__session_lock:
+                if self._session is None or self._session_pid != pid:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                          pool_maxsize=self.pool_maxsize,
+                                          max_retries=0)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({
+                        "Authorization": f"Bearer {self.auth_token}",
+                        "Content-Type": "application/json",
+                        "Connection": "keep-alive"
+                    })
+                    self._session = session
+                    self._session_pid = pid
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def backoff(self, attempt):
+        # full jitter keeps the workers from retrying in lock step
+        return random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+
+    def put(self, url, payload):
+        deadline = time.monotonic() + self.total_timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            timeout = (min(self.timeout[0], remaining), min(self.timeout[1], remaining))
+            error = None
+            try:
+                response = self.get_session().put(url, json=payload, timeout=timeout)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                error = e
+            delay = self.backoff(attempt)
+            # no retry unless there is still time to connect after the pause
+            if delay + self.timeout[0] >= deadline - time.monotonic():
+                if error is not None:
+                    raise error
+                return response
+            time.sleep(delay)
+            attempt += 1
+
+    def mask(self, values):
+        return self.put(self.mask_url, {"mask": [{"value": value} for value in values]})
+
+    def unmask(self, token_values):
+        return self.put(self.unmask_url, {"unmask": [{"token_value": value} for value in token_values]})
@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("my_logger")
+
+# shape of a placeholder produced by the mask api, e.g. "<PER>bRcLfydN0v</PER>"
+TOKEN_PATTERN = re.compile(r"<([A-Za-z_]+)>\s*[A-Za-z0-9]+\s*</\1>")
+
+
+class TokenMap:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.tokens = {}
+        self._matcher = None
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def add(self, identified_tokens, pii_identified):
+        if not identified_tokens or not pii_identified or len(identified_tokens) != len(pii_identified):
+            return
+        with self.__lock:
+            for token, value in zip(identified_tokens, pii_identified):
+                key = token["key"] if isinstance(token, dict) else token
+                if key and self.tokens.get(key) != value:
+                    self.tokens[key] = value
+                    self._matcher = None
+
+    def update(self, other):
+        with self.__lock:
+            self.tokens.update(other.tokens)
+            self._matcher = None
+
+    def get_matcher(self):
+        with self.__lock:
+            if self._matcher is None and self.tokens:
+                # longest keys first so a token never shadows a longer one sharing its prefix
+                keys = sorted(self.tokens, key=len, reverse=True)
+                self._matcher = re.compile("|".join(re.escape(key) for key in keys))
+            return self._matcher, self.tokens
+
+    def unmask(self, text):
+        # replaces every known token in one pass and reports the placeholders left unresolved
+        if not text:
+            return text, []
+        matcher, tokens = self.get_matcher()
+        if matcher is not None:
+            text = matcher.sub(lambda match: tokens[match.group(0)], text)
+        unknown = [match.group(0) for match in TOKEN_PATTERN.finditer(text)]
+        return text, unknown
+
+
+class ConversationTokenMaps:
+    __lock = threading.Lock()
+
+    def __init__(self, max_conversations=1000):
+        self.max_conversations = int(max_conversations)
+        self.maps = OrderedDict()
+
+    def get(self, conversation_key):
+        with ConversationTokenMaps.__lock:
+            token_map = self.maps.get(conversation_key)
+            if token_map is None:
+                token_map = TokenMap()
+                self.maps[conversation_key] = token_map
+                while len(self.maps) > self.max_conversations:
+                    self.maps.popitem(last=False)
+            else:
+                self.maps.move_to_end(conversation_key)
+            return token_map
+
+    def discard(self, conversation_key):
+        with ConversationTokenMaps.__lock:
+            self.maps.pop(conversation_key, None)
+
+
+class UserTokenStore:
+    # every token -> value pair a user was shown, so a reply quoting one from another conversation, an uploaded
+    # document or a turn handled by another worker is still unmasked without the unmask api. with redis all
+    # workers share the pairs, otherwise each keeps its own.
+
+    def __init__(self, secret, redis_client=None, ttl=86400, max_users=1000, key_prefix="gptguard:tokens:"):
+        self.secret = (secret or "").encode("utf-8")
+        self.redis_client = redis_client
+        self.ttl = int(ttl)
+        self.local = ConversationTokenMaps(max_users)
+        self.key_prefix = key_prefix
+
+    def key(self, user):
+        # neither the local map nor redis holds the email itself
+        return hmac.new(self.secret, user.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def save(self, user, identified_tokens, pii_identified):
+        if not identified_tokens or not pii_identified or len(identified_tokens) != len(pii_identified):
+            return
+        key = self.key(user)
+        self.local.get(key).add(identified_tokens, pii_identified)
+        if self.redis_client is None:
+            return
+        pairs = {token["key"] if isinstance(token, dict) else token: value
+                 for token, value in zip(identified_tokens, pii_identified)}
+        try:
+            pipeline = self.redis_client.pipeline()
+            pipeline.hset(self.key_prefix + key, mapping=pairs)
+            pipeline.expire(self.key_prefix + key, self.ttl)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"Unable to share identified tokens - {str(e)}")
+
+    def resolve(self, user, tokens):
+        """Returns {token: value} for the given tokens this user has been shown."""
+        key = self.key(user)
+        known = self.local.get(key).tokens
+        found = {token: known[token] for token in tokens if token in known}
+        missing = [token for token in tokens if token not in found]
+        if missing and self.redis_client is not None:
+            try:
+                values = self.redis_client.hmget(self.key_prefix + key, missing)
+            except Exception as e:
+                logger.warning(f"Unable to read shared identified tokens - {str(e)}")
+                values = []
+            for token, value in zip(missing, values):
+                if value is not None:
+                    found[token] = value.decode("utf-8") if isinstance(value, bytes) else value
+        return found
+
+
+# a placeholder cut short by the end of a stream delta, e.g. "<PE", "<PER>bRc" or "<PER>bRcLfydN0v</PE"
+PARTIAL_TOKEN_PATTERN = re.compile(r"<[A-Za-z_]*(?:>\s*[A-Za-z0-9]*\s*(?:<(?:/[A-Za-z_]*)?)?)?")
+
+
+class StreamingUnmasker:
+
+    def __init__(self, token_map, fallback=None, max_hold=64):
+        self.token_map = token_map
+        self.fallback = fallback
+        self.max_hold = int(max_hold)
+        self.buffer = ""
+        self.masked_text = ""
+
+    def safe_length(self, text):
+        # only a tail that could still grow into a placeholder is held back
+        position = text.find("<", max(0, len(text) - self.max_hold))
+        while position != -1:
+            if PARTIAL_TOKEN_PATTERN.fullmatch(text, position):
+                return position
+            position = text.find("<", position + 1)
+        return len(text)
+
+    def unmask(self, text):
+        text, unknown = self.token_map.unmask(text)
+        if unknown and self.fallback:
+            text = self.fallback(text)
+        return text
+
+    def feed(self, delta):
+        self.masked_text += delta
+        self.buffer += delta
+        cut = self.safe_length(self.buffer)
+        ready, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self.unmask(ready) if ready else ""
+
+    def flush(self):
+        ready, self.buffer = self.buffer, ""
+        return self.unmask(ready) if ready else ""
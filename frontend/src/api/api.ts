@@ -113,6 +113,23 @@ export const historyRead = async (convId: string): Promise<ChatMessage[]> => {
     return response
 }
 
+// Delta frames only carry the new text. The reader rebuilds the message shown so far, so every frame reaches the
+// page in the cumulative shape; the final frame already holds the full message and metadata and passes through.
+export const createStreamReader = () => {
+    let streamedContent = "";
+    return (frame: ChatResponse): ChatResponse => {
+        const delta = frame.choices?.[0]?.delta;
+        if (!delta) {
+            return frame;
+        }
+        streamedContent += delta.content ?? "";
+        return {
+            ...frame,
+            choices: [{ messages: [{ id: "", role: "assistant", content: streamedContent, date: "" }] }],
+        };
+    };
+}
+
 export const historyGenerate = async (options: ConversationRequest, abortSignal: AbortSignal, key?: string, isFile?: boolean, convId?: string): Promise<Response> => {
     let body;
     if (convId) {
@@ -120,12 +137,14 @@ export const historyGenerate = async (options: ConversationRequest, abortSignal:
             conversation_id: convId,
             filter: key,
             isFileUploaded: isFile,
+            stream_format: "delta",
             messages: options.messages
         })
     } else {
         body = JSON.stringify({
             filter: key,
             isFileUploaded: isFile,
+            stream_format: "delta",
             messages: options.messages
         })
     }
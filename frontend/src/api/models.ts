@@ -55,13 +55,16 @@ export enum ChatCompletionType {
 
 export type ChatResponseChoice = {
     messages: ChatMessage[];
+    delta?: {
+        content?: string;
+    };
 }
 
 export type ChatResponse = {
-    id: string;
-    model: string;
-    created: number;
-    object: ChatCompletionType;
+    id?: string;
+    model?: string;
+    created?: number;
+    object?: ChatCompletionType;
     choices: ChatResponseChoice[];
     history_metadata: {
         conversation_id: string;
@@ -49,6 +49,7 @@ import {
   ChatResponse,
   Conversation,
   historyGenerate,
+  createStreamReader,
   historyUpdate,
   ChatHistoryLoadingState,
   PostgresDBStatus,
@@ -927,6 +928,7 @@ const Chat = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -938,7 +940,7 @@ const Chat = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
@@ -1148,6 +1150,7 @@ const Chat = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -1159,7 +1162,7 @@ const Chat = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
@@ -1433,6 +1436,7 @@ const Chat = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -1444,7 +1448,7 @@ const Chat = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
@@ -52,6 +52,7 @@ import {
   ChatResponse,
   Conversation,
   historyGenerate,
+  createStreamReader,
   historyUpdate,
   ChatHistoryLoadingState,
   PostgresDBStatus,
@@ -894,6 +895,7 @@ const Public = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -905,7 +907,7 @@ const Public = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
@@ -1112,6 +1114,7 @@ const Public = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -1123,7 +1126,7 @@ const Public = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
@@ -1393,6 +1396,7 @@ const Public = () => {
       if (response?.body) {
         const reader = response.body.getReader();
         let runningText = "";
+        const readFrame = createStreamReader();
 
         while (true) {
           setProcessMessages(messageStatus.Processing);
@@ -1404,7 +1408,7 @@ const Public = () => {
           objects.forEach((obj) => {
             try {
               runningText += obj;
-              result = JSON.parse(runningText);
+              result = readFrame(JSON.parse(runningText));
               result.choices[0].messages.forEach((obj) => {
                 obj.id = uuid();
                 obj.date = new Date().toISOString();
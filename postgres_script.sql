@@ -1,3 +1,5 @@
+-- Schema for fresh installs. Existing databases are upgraded with the numbered migrations in
+-- backend/history/migrations, applied by "python -m backend.history.migrate".
 CREATE SCHEMA openai_chat;
 
 CREATE TABLE IF NOT EXISTS openai_chat.users
@@ -16,7 +18,7 @@ CREATE TABLE IF NOT EXISTS openai_chat.conversations
     title character varying NOT NULL,
     CONSTRAINT conversations_pkey PRIMARY KEY (conversation_id),
     CONSTRAINT conversations_user_id_fkey FOREIGN KEY (user_id)
-        REFERENCES openai_chat.users (user_id)
+        REFERENCES openai_chat.users (user_id) ON DELETE CASCADE
 );
 
 CREATE TABLE IF NOT EXISTS openai_chat.messages
@@ -24,7 +26,7 @@ CREATE TABLE IF NOT EXISTS openai_chat.messages
     message_id uuid NOT NULL,
     created_at timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL,
     updated_at timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL,
-    conversation_id uuid,
+    conversation_id uuid NOT NULL,
     role character varying NOT NULL,
     content text,
     masked_content text,
@@ -32,6 +34,36 @@ CREATE TABLE IF NOT EXISTS openai_chat.messages
     is_file_data boolean DEFAULT false,
     tokens_identified text,-- New column
     CONSTRAINT messages_pkey PRIMARY KEY (message_id),
+    CONSTRAINT messages_role_check CHECK (role IN ('system', 'user', 'assistant')),
     CONSTRAINT messages_conversation_id_fkey FOREIGN KEY (conversation_id)
-        REFERENCES openai_chat.conversations (conversation_id)
+        REFERENCES openai_chat.conversations (conversation_id) ON DELETE CASCADE
+);
+
+-- no foreign key: conversations whose history the client keeps have no row in openai_chat.conversations,
+-- so the delete statements remove summaries together with the conversation instead
+CREATE TABLE IF NOT EXISTS openai_chat.conversation_summaries
+(
+    conversation_id uuid NOT NULL,
+    updated_at timestamp DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    summary text NOT NULL,
+    compacted_count integer NOT NULL,
+    history_digest character varying NOT NULL,
+    CONSTRAINT conversation_summaries_pkey PRIMARY KEY (conversation_id)
 );
+
+-- Databases created before the cascades were added
+ALTER TABLE openai_chat.conversations
+    DROP CONSTRAINT IF EXISTS conversations_user_id_fkey,
+    ADD CONSTRAINT conversations_user_id_fkey FOREIGN KEY (user_id)
+        REFERENCES openai_chat.users (user_id) ON DELETE CASCADE;
+
+ALTER TABLE openai_chat.messages
+    DROP CONSTRAINT IF EXISTS messages_conversation_id_fkey,
+    ADD CONSTRAINT messages_conversation_id_fkey FOREIGN KEY (conversation_id)
+        REFERENCES openai_chat.conversations (conversation_id) ON DELETE CASCADE;
+
+CREATE INDEX IF NOT EXISTS messages_conversation_id_created_at_idx
+    ON openai_chat.messages (conversation_id, created_at);
+
+CREATE INDEX IF NOT EXISTS conversations_user_id_updated_at_idx
+    ON openai_chat.conversations (user_id, updated_at);
@@ -3,4 +3,824 @@ from app import format_as_ndjson
 
 def test_format_as_ndjson():
     obj = {"message": "I ❤️ 🐍 \n and escaped newlines"}
-    assert format_as_ndjson(obj) == '{"message": "I ❤️ 🐍 \\n and escaped newlines"}\n'
+    assert format_as_ndjson(obj) == '{"message":"I ❤️ 🐍 \\n and escaped newlines"}\n'
+
+
+def test_frame_structure_for_private_masks_in_one_batch(monkeypatch):
+    import app
+
+    calls = []
+
+    class FakeResponse:
+        def __init__(self, values):
+            self.values = values
+
+        def json(self):
+            return {"success": True, "data": [
+                {"value": v, "token_value": f"<M>{v}</M>",
+                 "individual_tokens": [{"prefix": "<M>", "token": v, "suffix": "</M>", "value": v}]}
+                for v in self.values]}
+
+    def fake_mask(values):
+        calls.append(values)
+        return FakeResponse(values)
+
+    monkeypatch.setattr(app.tokenisation_client, "mask", fake_mask)
+    messages = [
+        {"role": "user", "content": "a", "is_file_data": False, "masked_content": None},
+        {"role": "assistant", "content": "b", "is_file_data": False, "masked_content": "B"},
+        {"role": "user", "content": "c", "is_file_data": False, "masked_content": None},
+    ]
+    _, framed, masked_user, pii, tokens = app.frame_structure_for_private(messages)
+
+    assert len(calls) == 1
+    assert [m["content"] for m in framed] == ["<M>a</M>", "B", "<M>c</M>"]
+    assert masked_user == "<M>c</M>"
+    assert pii == ["c"]
+    assert tokens == [{"key": "<M>c</M>"}]
+
+
+def test_tokenisation_client_retries_transient_failures(monkeypatch):
+    import pytest
+    import requests
+    from backend.tokenisation.tokenisationservice import TokenisationClient
+
+    client = TokenisationClient("http://mask", "http://unmask", "token", max_retries=2, backoff_factor=0)
+    outcomes = [requests.ConnectionError("reset"), type("R", (), {"status_code": 503})(),
+                type("R", (), {"status_code": 200})()]
+
+    def fake_put(url, json, timeout):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(client.get_session(), "put", fake_put)
+    assert client.mask(["hello"]).status_code == 200
+    assert outcomes == []
+
+    from backend.tokenisation import tokenisationservice
+
+    # every attempt takes 0.8s of a 2s budget, so the client gives up after the second instead of the sixth
+    clock = [0.0]
+    timeouts = []
+
+    def slow_put(url, json, timeout):
+        timeouts.append(timeout)
+        clock[0] += 0.8
+        raise requests.Timeout("read timed out")
+
+    client = TokenisationClient("http://mask", "http://unmask", "token", connect_timeout=0.5, read_timeout=30,
+                                max_retries=5, backoff_factor=0, total_timeout=2)
+    monkeypatch.setattr(tokenisationservice.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(client.get_session(), "put", slow_put)
+    with pytest.raises(requests.Timeout):
+        client.mask(["hello"])
+    assert [read_timeout for _, read_timeout in timeouts] == pytest.approx([2, 1.2])
+
+
+def test_token_map_unmasks_known_tokens_and_reports_unknown():
+    from backend.tokenisation.tokenmap import TokenMap
+
+    token_map = TokenMap()
+    token_map.add([{"key": "<PER>abc</PER>"}, {"key": "<ADDRESS>xyz</ADDRESS>"}], ["John", "London"])
+    text, unknown = token_map.unmask("<PER>abc</PER> lives in <ADDRESS>xyz</ADDRESS> with <PER>qqq</PER>")
+
+    assert text == "John lives in London with <PER>qqq</PER>"
+    assert unknown == ["<PER>qqq</PER>"]
+
+
+def test_reply_quoting_an_uploaded_document_is_unmasked_locally(monkeypatch):
+    import app
+    from backend.tokenisation.tokenmap import TokenMap, UserTokenStore
+
+    remote = []
+    monkeypatch.setattr(app, "token_store", UserTokenStore("secret"))
+    monkeypatch.setattr(app, "tokenisation_unmask_call", lambda text: remote.append(text) or text)
+
+    with app.app.test_request_context("/upload-file", headers={"email": "a@b.c"}):
+        app.remember_tokens([{"key": "<PER>abc</PER>"}], ["John"])
+
+    # a new conversation on any worker finds the document's tokens under the same user
+    assert app.unmask_response("Signed by <PER>abc</PER>", TokenMap(), "a@b.c") == "Signed by John"
+    assert remote == []
+    assert app.unmask_response("Signed by <PER>abc</PER>", TokenMap(), "x@y.z") == "Signed by <PER>abc</PER>"
+    assert remote == ["Signed by <PER>abc</PER>"]
+
+
+def test_ttl_cache_evicts_least_recently_used_and_expires(monkeypatch):
+    from backend.cache import lrucache
+
+    now = [100.0]
+    monkeypatch.setattr(lrucache.time, "monotonic", lambda: now[0])
+    cache = lrucache.TTLCache(max_entries=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    now[0] += 11
+    assert cache.get("a") is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["expirations"] == 1
+
+
+def test_pii_prescreen_only_clears_text_without_detections():
+    from backend.tokenisation.prescreen import PiiPrescreen
+
+    prescreen = PiiPrescreen(max_length=60)
+    assert prescreen.screen("summarise the above") is None
+    assert prescreen.screen("Thanks!") is None
+    assert prescreen.screen("Explain it to Sam") == "name"
+    assert prescreen.screen("card 4111 1111 1111 1111") == "card"
+    assert prescreen.screen("reach me on jane@example.com") == "email"
+    assert prescreen.screen("thanks " * 20) == "length"
+
+
+def test_mask_in_chunks_splits_on_boundaries_and_stitches_in_order():
+    from backend.tokenisation.chunking import split_text, mask_in_chunks
+
+    text = "First paragraph here.\n\nSecond one. It has two sentences.\n\nThird."
+    chunks = split_text(text, 25)
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= 25 for chunk in chunks)
+
+    def fake_mask(chunk):
+        return chunk.upper(), [chunk], [{"key": chunk.upper()}]
+
+    masked, pii, tokens = mask_in_chunks(text, fake_mask, 25, 2)
+    assert masked == text.upper()
+    assert pii == chunks
+    assert [token["key"] for token in tokens] == [chunk.upper() for chunk in chunks]
+
+
+class WordEncoding:
+    name = "words"
+
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+def test_trim_to_budget_keeps_the_newest_messages_that_fit(monkeypatch):
+    from backend.llm import tokenbudget
+    from backend.llm.tokenbudget import trim_to_budget, count_prompt_tokens, load_encoding
+
+    encoding = WordEncoding()
+    messages = [{"role": "user", "content": "one two three four"},
+                {"role": "assistant", "content": "five six"},
+                {"role": "user", "content": "seven"}]
+    # each message costs 3 + 1 (role) + words, plus 3 for the reply
+    kept, tokens = trim_to_budget(messages, 3 + 6 + 5, encoding)
+
+    assert kept == messages[1:]
+    assert tokens == count_prompt_tokens(kept, encoding) == 14
+
+    # an unset or unknown model falls back to the default encoding instead of failing the request
+    monkeypatch.setattr(tokenbudget.tiktoken, "get_encoding", lambda name: name)
+    assert load_encoding(None) == load_encoding("ft:unknown-model:org::id") == tokenbudget.DEFAULT_ENCODING
+
+
+def test_cached_token_counter_encodes_each_text_once():
+    from backend.llm.tokenbudget import CachedTokenCounter
+
+    class CountingEncoding(WordEncoding):
+        calls = 0
+
+        def encode(self, text, disallowed_special=()):
+            CountingEncoding.calls += 1
+            return super().encode(text)
+
+    counter = CachedTokenCounter(max_entries=10)
+    encoding = CountingEncoding()
+    assert counter("a b c", encoding) == 3
+    assert counter("a b c", encoding) == 3
+    assert CountingEncoding.calls == 1
+    assert counter.stats()["hits"] == 1
+
+
+def test_stream_without_data_unmasks_split_placeholders():
+    import json
+    from app import stream_without_data
+    from backend.tokenisation.tokenmap import TokenMap, StreamingUnmasker
+
+    token_map = TokenMap()
+    token_map.add([{"key": "<PER>abc</PER>"}], ["John"])
+    chunks = [{"id": "1", "model": "m", "created": 0, "object": "chat.completion.chunk",
+               "choices": [{"delta": {"content": delta}}]} for delta in ["Hi <PE", "R>abc</P", "ER>!"]]
+    frames = [json.loads(frame) for frame in stream_without_data(
+        iter(chunks), {"conversation_id": "c"}, StreamingUnmasker(token_map), {"identified_pii": ["John"]})]
+
+    deltas = [frame["choices"][0]["delta"]["content"] for frame in frames[:-1]]
+    assert all("<" not in delta for delta in deltas)
+    assert "".join(deltas) == "Hi John!"
+    final = frames[-1]["choices"][0]["messages"][0]
+    assert final["content"] == "Hi John!"
+    assert final["masked_content_assistant"] == "Hi <PER>abc</PER>!"
+    assert final["identified_pii"] == ["John"]
+
+
+def test_stream_without_data_cumulative_frames_for_older_clients():
+    import json
+    from app import stream_without_data
+
+    chunks = [{"id": "1", "model": "m", "created": 0, "object": "chat.completion.chunk",
+               "choices": [{"delta": {"content": delta}}]} for delta in ["a", "b"]]
+    frames = [json.loads(frame) for frame in stream_without_data(iter(chunks), {"conversation_id": "c"},
+                                                                 cumulative=True)]
+
+    assert [frame["choices"][0]["messages"][0]["content"] for frame in frames] == ["a", "ab", "ab"]
+
+
+def test_chat_completion_serves_repeated_masked_prompt_from_cache(monkeypatch):
+    import app
+    from backend.llm.completioncache import CompletionCache
+
+    calls = []
+
+    def fake_create(**params):
+        calls.append(params)
+        from openai.util import convert_to_openai_object
+        return convert_to_openai_object({
+            "id": "x", "object": "chat.completion", "created": 1, "model": params["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "<PER>abc</PER>"},
+                         "finish_reason": "stop"}]})
+
+    monkeypatch.setattr(app, "completion_cache", CompletionCache(max_entries=10))
+    monkeypatch.setattr(app.openai.ChatCompletion, "create", fake_create)
+    params = {"model": "m", "messages": [{"role": "user", "content": "<PER>abc</PER>?"}],
+              "temperature": 0, "stream": False}
+
+    first = app.chat_completion(dict(params), tenant="vault")
+    second = app.chat_completion(dict(params), tenant="vault")
+    app.chat_completion(dict(params), tenant="other-vault")
+
+    assert second.choices[0].message.content == first.choices[0].message.content
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_one_upstream_call_between_concurrent_requests():
+    import threading
+    import time
+    from backend.llm.singleflight import SingleFlight
+    from backend.monitoring.metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    single_flight = SingleFlight(metrics=registry)
+    release = threading.Event()
+    calls = []
+
+    def upstream():
+        calls.append(1)
+        release.wait(5)
+        return iter(["a", "b", "c"])
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(list(single_flight.do("k", upstream, stream=True))))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while registry.snapshot()["counters"].get("single_flight.follower", 0) < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [["a", "b", "c"]] * 3
+
+    from backend.llm.openaiservice import Deadline
+
+    # a follower whose deadline runs out before the leader finishes calls upstream itself
+    leader_done = threading.Event()
+    slow_calls = []
+
+    def slow_upstream():
+        slow_calls.append(1)
+        if len(slow_calls) == 1:
+            leader_done.wait(5)
+        return "result"
+
+    leader = threading.Thread(target=single_flight.do, args=("slow", slow_upstream))
+    leader.start()
+    while not slow_calls:
+        time.sleep(0.01)
+    assert single_flight.do("slow", slow_upstream, deadline=Deadline(0.1)) == "result" and len(slow_calls) == 2
+    leader_done.set()
+    leader.join(5)
+
+
+def test_openai_client_honours_retry_after_within_the_deadline(monkeypatch):
+    import openai
+    import pytest
+    from backend.llm import openaiservice
+    from backend.llm.openaiservice import OpenAIClient, Deadline
+
+    sleeps = []
+    attempts = []
+
+    def fake_create(**params):
+        attempts.append(params["request_timeout"])
+        if len(attempts) == 1:
+            raise openai.error.RateLimitError("slow down", headers={"retry-after": "0.5"})
+        return "ok"
+
+    monkeypatch.setattr(openaiservice.openai.ChatCompletion, "create", fake_create)
+    monkeypatch.setattr(openaiservice.time, "sleep", sleeps.append)
+    monkeypatch.setattr(openai, "requestssession", None)
+    client = OpenAIClient("key", read_timeout=60, max_retries=2)
+
+    assert client.create_chat_completion({"model": "m"}, Deadline(30), reserve=5) == "ok"
+    assert sleeps == [0.5]
+    assert all(read_timeout <= 25 for _, read_timeout in attempts)
+
+    hints = ["12"]
+
+    def rate_limited(**params):
+        if hints:
+            raise openai.error.RateLimitError("slow down", headers={"retry-after": hints.pop()})
+        return "ok"
+
+    # a hint longer than backoff_max is still honoured, and one past the deadline is not waited for at all
+    monkeypatch.setattr(openaiservice.openai.ChatCompletion, "create", rate_limited)
+    sleeps.clear()
+    assert client.create_chat_completion({"model": "m"}) == "ok" and sleeps == [12]
+    hints.append("40")
+    with pytest.raises(openai.error.RateLimitError):
+        client.create_chat_completion({"model": "m"}, Deadline(30))
+    assert sleeps == [12]
+
+    # openai closes its thread's session every few minutes, which must not drop the pool the worker shares
+    session = openai.requestssession()
+    closed = []
+    monkeypatch.setattr(session.get_adapter("https://api.openai.com"), "close", lambda: closed.append(True))
+    session.close()
+    assert closed == [] and client.get_session() is session
+
+
+def test_admission_controller_sheds_load_when_the_queue_is_full():
+    import pytest
+    from backend.llm.admission import AdmissionController, AdmissionRejected, LocalRateLimiter
+
+    limiter = LocalRateLimiter(tokens_per_minute=600, requests_per_minute=60)
+    controller = AdmissionController(limiter, max_queue=0, max_wait=5)
+
+    assert controller.admit(500) == 0
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(500)
+    assert rejected.value.retry_after >= 1
+
+    import redis
+    from backend.llm.admission import RedisRateLimiter
+
+    # nothing listens on this port, so every redis call fails and the worker's own buckets take over
+    unreachable = redis.Redis(port=1, socket_connect_timeout=0.1)
+    controller = AdmissionController(RedisRateLimiter(unreachable, tokens_per_minute=600, requests_per_minute=60),
+                                     max_queue=0, max_wait=5)
+    assert controller.admit(500) == 0
+    with pytest.raises(AdmissionRejected):
+        controller.admit(500)
+    assert controller.stats() == {"queue_depth": 0}
+
+
+def test_fair_share_scheduler_serves_queued_users_round_robin():
+    import threading
+    import time
+    import pytest
+    from backend.scheduling.fairshare import FairShareScheduler, QueueRejected
+
+    scheduler = FairShareScheduler(max_in_flight=1, max_per_user=1, max_queue=10, max_wait=5)
+    release_first = scheduler.enter("alice")
+    order = []
+
+    def request(user, name):
+        release = scheduler.enter(user)
+        order.append(name)
+        release()
+
+    threads = []
+    for user, name in [("alice", "a2"), ("alice", "a3"), ("bob", "b1")]:
+        thread = threading.Thread(target=request, args=(user, name))
+        thread.start()
+        threads.append(thread)
+        while scheduler.stats()["queue_depth"] < len(threads):
+            time.sleep(0.01)
+    release_first()
+    for thread in threads:
+        thread.join(5)
+
+    assert order == ["a2", "b1", "a3"]
+
+    class SharedSlots:
+        # alice's requests on other workers hold her shared slots until she is let through
+        def __init__(self):
+            self.alice_blocked = True
+            self.released = []
+
+        def try_acquire(self, user):
+            return None if user == "alice" and self.alice_blocked else f"{user}-slot"
+
+        def release(self, user, ticket):
+            self.released.append(ticket)
+
+    shared_slots = SharedSlots()
+    scheduler = FairShareScheduler(max_in_flight=1, max_per_user=1, max_queue=10, max_wait=5,
+                                   shared_slots=shared_slots)
+    # a user at the shared limit is turned away at once instead of parking a worker, and others still get in
+    with pytest.raises(QueueRejected) as rejected:
+        scheduler.enter("alice")
+    assert rejected.value.retry_after >= 1
+    scheduler.enter("bob")()
+    shared_slots.alice_blocked = False
+    scheduler.enter("alice")()
+    assert shared_slots.released == ["bob-slot", "alice-slot"] and scheduler.stats()["in_flight"] == 0
+
+
+def test_model_router_picks_the_cheapest_model_that_fits():
+    from backend.llm.routing import ModelRouter
+
+    router = ModelRouter.from_json('[{"model": "small", "context_window": 4096, "cost": 1},'
+                                   ' {"model": "large", "context_window": 16384, "cost": 2}]')
+
+    assert router.choose(2000, 1000).route.model == "small"
+    assert router.choose(5000, 1000).route.model == "large"
+    decision = router.choose(20000, 1000)
+    assert decision.route.model == "large" and not decision.fits
+
+    # the configured model competes at its listed cost, so short prompts still go to the cheaper one
+    routes = ('[{"model": "gpt-35-turbo", "context_window": 4096, "cost": 1},'
+              ' {"model": "gpt-4-32k", "context_window": 32768, "cost": 20}]')
+    router = ModelRouter.from_json(routes, "gpt-4-32k", 4096)
+    assert router.choose(100, 1000).route.model == "gpt-35-turbo"
+    assert router.choose(5000, 1000).route.model == "gpt-4-32k"
+
+    # a preferred model, e.g. a fine-tuned one, keeps every prompt it can hold
+    router = ModelRouter.from_json('[{"model": "large", "context_window": 16384, "cost": 2}]', "ft:small:org::id", 4096,
+                                   prefer_default=True)
+    assert router.choose(2000, 1000).route.model == "ft:small:org::id"
+    assert router.choose(5000, 1000).route.model == "large"
+
+
+def test_document_retriever_prompts_only_the_relevant_chunks():
+    from backend.retrieval.bm25 import DocumentRetriever
+
+    paragraphs = ["Holidays: employees get twenty days of paid leave.",
+                  "Expenses: travel is reimbursed within thirty days.",
+                  "Security: badges must be worn at all times."]
+    document = "\n\n".join(paragraphs * 3)
+    retriever = DocumentRetriever(chunk_chars=60, top_k=2, min_chars=100)
+
+    excerpt = retriever.excerpt(document, "how is travel reimbursed?")
+    assert "reimbursed" in excerpt
+    assert "badges" not in excerpt and "paid leave" not in excerpt
+    assert retriever.excerpt("short text", "anything") == "short text"
+
+
+def test_history_compactor_folds_old_turns_into_a_summary():
+    from backend.history.compaction import HistoryCompactor, LocalSummaryStore
+
+    folded = []
+
+    def summarise(summary, messages):
+        folded.append(len(messages))
+        return f"{summary or ''}+{len(messages)}"
+
+    compactor = HistoryCompactor(LocalSummaryStore(), summarise, submit=lambda fn, *args: fn(*args),
+                                 trigger_messages=4, keep_recent=2)
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i}"} for i in range(7)]
+
+    summary, recent = compactor.compact("c1", history)
+    assert summary is None and recent == history and folded == [5]
+
+    summary, recent = compactor.compact("c1", history + [{"role": "assistant", "content": "turn 7"}])
+    assert summary == "+5" and [message["content"] for message in recent] == ["turn 5", "turn 6", "turn 7"]
+
+    edited = [{"role": "user", "content": "edited"}] + history[1:]
+    summary, recent = compactor.compact("c1", edited)
+    assert summary is None
+
+    class FailingStore:
+        def get_conversation_summary(self, conversation_id):
+            return None
+
+        def upsert_conversation_summary(self, conversation_id, summary, compacted_count, history_digest):
+            raise Exception("violates foreign key constraint")
+
+    # a summary the store cannot save is still used, and not requested again on the next turn
+    folded.clear()
+    compactor = HistoryCompactor(FailingStore(), summarise, submit=lambda fn, *args: fn(*args),
+                                 trigger_messages=4, keep_recent=2)
+    compactor.compact("c2", history)
+    summary, recent = compactor.compact("c2", history + [{"role": "assistant", "content": "turn 7"}])
+    assert summary == "+5" and len(recent) == 3 and folded == [5]
+
+
+def test_conversation_store_loads_stored_turns_through_the_cache():
+    import uuid
+    import pytest
+    from backend.history.conversationstate import ConversationStore, ConversationAccessDenied
+
+    class FakeDatabase:
+        def __init__(self):
+            self.conversations = {}
+            self.rows = []
+            self.message_reads = 0
+
+        def get_conversation(self, conversation_id):
+            return self.conversations.get(conversation_id)
+
+        def create_turn(self, user_id, conversation_id, messages, title=''):
+            conversation = self.conversations.setdefault(conversation_id, {"user_id": user_id, "updated_at": 0})
+            if conversation["user_id"] != user_id:
+                return []
+            conversation["updated_at"] += 1
+            for message in messages:
+                self.rows.append({"role": message["role"], "content": message["content"],
+                                  "masked_content": message.get("masked_content"), "is_file_data": False,
+                                  "tokens_identified": str(message.get("identified_tokens")),
+                                  "pii_identified": str(message.get("identified_pii"))})
+            return [{"message_id": str(uuid.uuid4()), "conversation_updated_at": conversation["updated_at"]}
+                    for message in messages]
+
+        def get_messages(self, conversation_id):
+            self.message_reads += 1
+            return self.rows
+
+    database = FakeDatabase()
+    store = ConversationStore(database)
+    conversation_id = str(uuid.uuid4())
+    assert store.load(conversation_id, "u1") == []
+
+    store.append("u1", conversation_id, [
+        {"role": "user", "content": "I am John", "masked_content": "I am <PER>abc</PER>",
+         "identified_tokens": [{"key": "<PER>abc</PER>"}], "identified_pii": ["John"]},
+        {"role": "assistant", "content": "Hello John", "masked_content": "Hello <PER>abc</PER>"}])
+    history = store.load(conversation_id, "u1")
+    assert [message["masked_content"] for message in history] == ["I am <PER>abc</PER>", "Hello <PER>abc</PER>"]
+    assert history[0]["identified_tokens"] == [{"key": "<PER>abc</PER>"}]
+    assert store.load(conversation_id, "u1") == history and database.message_reads == 1
+
+    # turns saved through the store extend the cached history without re-reading it
+    store.append("u1", conversation_id, [{"role": "user", "content": "thanks"},
+                                         {"role": "assistant", "content": "welcome"}])
+    assert len(store.load(conversation_id, "u1")) == 4 and database.message_reads == 1
+
+    # a turn written by another worker bumps updated_at and forces a reload
+    database.rows.append(dict(database.rows[0]))
+    database.conversations[conversation_id]["updated_at"] += 1
+    assert len(store.load(conversation_id, "u1")) == 5 and database.message_reads == 2
+
+    # another user can neither read the conversation nor add turns to it
+    with pytest.raises(ConversationAccessDenied):
+        store.load(conversation_id, "u2")
+    with pytest.raises(ConversationAccessDenied):
+        store.append("u2", conversation_id, [{"role": "user", "content": "hi"}])
+    assert len(database.rows) == 5
+
+
+def test_response_envelope_keeps_only_the_selected_fields():
+    import app
+
+    response_obj = {"id": "chatcmpl-1", "model": "gpt", "created": 1, "object": "chat.completion",
+                    "choices": [{"messages": [{"role": "assistant", "content": "hi"}]}],
+                    "history_metadata": {"conversation_id": "c1"}}
+
+    with app.app.test_request_context("/conversation"):
+        assert list(app.select_fields(response_obj, app.get_response_fields())) == [
+            "id", "choices", "history_metadata"]
+    with app.app.test_request_context("/conversation?fields=choices,unknown"):
+        assert list(app.select_fields(response_obj, app.get_response_fields())) == ["choices"]
+    assert app.dumps_json({"a": [1, "é"]}) == '{"a":[1,"é"]}'
+
+
+def test_database_prepares_each_statement_once_per_connection(monkeypatch):
+    import pytest
+    from types import SimpleNamespace
+    from backend.history.postgresdbservice import Database
+    from backend.history.statements import statements
+
+    statement = statements["rename_conversation"]
+    assert str(statement.prepare_text).endswith("title = $1 where conversation_id = $2;")
+    assert str(statement.execute_text) == "EXECUTE openai_chat_rename_conversation(:title, :cov_id)"
+
+    executed = []
+    connection = SimpleNamespace(info={})
+
+    class FakeResult:
+        def mappings(self):
+            return self
+
+        def all(self):
+            return [{"user_id": "u1"}]
+
+    class FakeSession:
+        def connection(self):
+            return connection
+
+        def execute(self, query, values=None):
+            executed.append(str(query).split(" ")[0])
+            if executed[-1] == "EXECUTE" and values["email"] == "broken":
+                raise Exception("cached plan must not change result type")
+            return FakeResult()
+
+        def commit(self):
+            pass
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(Database, "session_maker", FakeSession)
+    database = Database.__new__(Database)
+    database.prepared_statements = True
+
+    assert database.get_user_id("a@b.c") == "u1"
+    assert database.get_user_id("a@b.c") == "u1"
+    assert executed == ["PREPARE", "EXECUTE", "EXECUTE"]
+
+    # a failed statement makes the connection drop and re-prepare its statements
+    with pytest.raises(Exception):
+        database.get_user_id("broken")
+    executed.clear()
+    assert database.get_user_id("a@b.c") == "u1"
+    assert executed == ["DEALLOCATE", "PREPARE", "EXECUTE"]
+
+
+def test_user_directory_resolves_each_email_once_until_deleted():
+    import itertools
+    from backend.history.users import UserDirectory
+
+    class FakeDatabase:
+        def __init__(self):
+            self.ids = itertools.count(1)
+            self.users = {}
+            self.lookups = 0
+
+        def resolve_user_id(self, email):
+            self.lookups += 1
+            if email not in self.users:
+                self.users[email] = f"user-{next(self.ids)}"
+            return self.users[email]
+
+        def delete_user(self, email):
+            return self.users.pop(email, None) is not None
+
+    class FakeRedis:
+        def __init__(self):
+            self.values = {}
+
+        def get(self, key):
+            return self.values.get(key)
+
+        def pipeline(self):
+            return self
+
+        def incr(self, key):
+            self.values[key] = self.values.get(key, 0) + 1
+
+        def expire(self, key, ttl):
+            pass
+
+        def execute(self):
+            pass
+
+    database = FakeDatabase()
+    redis_client = FakeRedis()
+    directory = UserDirectory(database, redis_client=redis_client)
+    other_worker = UserDirectory(database, redis_client=redis_client)
+
+    assert directory.get_user_id("a@b.c") == "user-1"
+    assert directory.get_user_id("a@b.c") == "user-1"
+    assert other_worker.get_user_id("a@b.c") == "user-1"
+    assert database.lookups == 2
+
+    assert directory.delete_user("a@b.c")
+    assert directory.get_user_id("a@b.c") == "user-2"
+    assert other_worker.get_user_id("a@b.c") == "user-2"
+    assert database.lookups == 4
+
+
+def test_history_delete_all_removes_a_users_conversations_in_one_call(monkeypatch):
+    import app
+
+    calls = []
+
+    class FakeDatabase:
+        def delete_all_conversations(self, user_id):
+            calls.append(user_id)
+            return ["c1", "c2"]
+
+    class FakeDirectory:
+        def get_user_id(self, email):
+            return f"id-{email}"
+
+    monkeypatch.setattr(app, "postgres_db_client", FakeDatabase())
+    monkeypatch.setattr(app, "user_directory", FakeDirectory())
+
+    response = app.app.test_client().delete("/history/delete_all", json={}, headers={"email": "a@b.c"})
+    assert response.status_code == 200
+    assert response.get_json()["conversation_ids"] == ["c1", "c2"]
+    assert calls == ["id-a@b.c"]
+
+
+def test_delta_request_without_conversation_id_starts_a_new_conversation(monkeypatch):
+    import uuid
+    from types import SimpleNamespace
+    import app
+    from backend.history.conversationstate import ConversationStore
+
+    turns = []
+
+    class FakeDatabase:
+        def get_conversation(self, conversation_id):
+            return None
+
+        def create_turn(self, user_id, conversation_id, messages, title=''):
+            turns.append((user_id, conversation_id, [message["content"] for message in messages]))
+            return [{"message_id": str(uuid.uuid4()), "conversation_updated_at": 1} for message in messages]
+
+    class FakeDirectory:
+        def get_user_id(self, email):
+            return "u1"
+
+    def chat_completion(params, tenant=None, deadline=None, estimated_tokens=0):
+        return SimpleNamespace(id="chatcmpl-1", model=params["model"], created=1, object="chat.completion",
+                               choices=[SimpleNamespace(message=SimpleNamespace(content="hello"))])
+
+    monkeypatch.setattr(app, "postgres_db_client", FakeDatabase())
+    monkeypatch.setattr(app, "user_directory", FakeDirectory())
+    monkeypatch.setattr(app, "conversation_store", ConversationStore(FakeDatabase()))
+    monkeypatch.setattr(app, "scheduler", None)
+    monkeypatch.setattr(app, "history_compactor", None)
+    monkeypatch.setattr(app, "chat_completion", chat_completion)
+    monkeypatch.setattr(app, "get_encoding", lambda model: WordEncoding())
+
+    response = app.app.test_client().post("/history/generate", headers={"email": "a@b.c"}, json={
+        "delta": True, "filter": "public", "isFileUploaded": False,
+        "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 200
+    conversation_id = response.get_json()["history_metadata"]["conversation_id"]
+    assert str(uuid.UUID(conversation_id)) == conversation_id
+    assert turns == [("u1", conversation_id, ["hi", "hello"])]
+
+
+def test_create_turn_sends_the_whole_turn_as_one_statement(monkeypatch):
+    import json
+    from backend.history.postgresdbservice import Database
+
+    executed = []
+
+    def execute_statement(self, name, values=None, with_result=False):
+        executed.append((name, values))
+        return [{"message_id": "m1"}, {"message_id": "m2"}]
+
+    monkeypatch.setattr(Database, "execute_statement", execute_statement)
+    database = Database.__new__(Database)
+
+    inserted = database.create_turn("u1", "c1", [
+        {"role": "user", "content": "I am John", "masked_content": "I am <PER>abc</PER>", "identified_pii": ["John"]},
+        {"role": "assistant", "content": "Hello John", "masked_content": "Hello <PER>abc</PER>"}])
+
+    assert len(inserted) == 2
+    [(name, values)] = executed
+    assert name == "create_turn" and values["cov_id"] == "c1" and values["user_id"] == "u1"
+    turn = json.loads(values["messages"])
+    assert [(message["role"], message["position"]) for message in turn] == [("user", 0), ("assistant", 1)]
+    assert turn[0]["pii_identified"] == "['John']" and turn[1]["pii_identified"] is None
+
+
+def test_migration_runner_applies_pending_migrations_in_order():
+    from contextlib import contextmanager
+    from backend.history.migrate import (MigrationRunner, load_migrations, plan_index_names, INDEXED_QUERIES)
+
+    migrations = load_migrations()
+    assert [migration.version for migration in migrations] == sorted({m.version for m in migrations})
+    schema = "".join(migration.read() for migration in migrations)
+    assert all(index_name in schema for index_name in INDEXED_QUERIES.values())
+
+    executed = []
+
+    class FakeConnection:
+        def execute(self, query, values=None):
+            executed.append((str(query), values))
+            return [(1,)] if "select version" in str(query) else []
+
+        def exec_driver_sql(self, sql):
+            executed.append((sql, None))
+
+    class FakeEngine:
+        @contextmanager
+        def begin(self):
+            yield FakeConnection()
+
+    applied = MigrationRunner(FakeEngine()).run()
+    assert [migration.version for migration in applied] == [m.version for m in migrations if m.version != 1]
+    recorded = [values["version"] for query, values in executed if "insert into openai_chat.schema_migrations" in query]
+    assert recorded == [migration.version for migration in applied]
+    assert "pg_advisory_xact_lock" in executed[0][0]
+
+    plan = [{"Plan": {"Node Type": "Limit", "Plans": [
+        {"Node Type": "Index Scan", "Index Name": "messages_conversation_id_created_at_idx"}]}}]
+    assert plan_index_names(plan) == {"messages_conversation_id_created_at_idx"}